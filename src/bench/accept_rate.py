@@ -0,0 +1,106 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import os
+import time
+
+import trio
+
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.gatehouse.abc_rule import ABCRule  # noqa: E402
+from src.gatehouse.gatehouse import Gatehouse  # noqa: E402
+from src.metrics import Metrics  # noqa: E402
+from src.utils import IOQueue, ReplySlot  # noqa: E402
+
+
+class CheapRule(ABCRule):
+    name = "Cheap Rule"
+
+    async def handle(self, proto, addr) -> bool:
+        await trio.sleep(0)
+        return True
+
+
+class Consul:
+    def __init__(self):
+        self.config = {"gatehouse": {"latency-target": float("inf")}, "redis": {}}
+        self.db = type("DB", (), {"in_queue": IOQueue()})()
+        self.metrics = Metrics()
+
+
+class QueuedGatehouse:
+    """The previous design: a pool of gate tasks fed through an input queue and answering on a second one."""
+
+    def __init__(self, rules, gates: int):
+        self.rules = rules
+        self.gates = gates
+        self.in_queue = IOQueue()
+        self.out_queue = IOQueue()
+        self.pending: dict[int, ReplySlot] = {}
+
+    async def router(self):
+        async for res, cid in self.out_queue:
+            self.pending.pop(cid).resolve(res)
+
+    async def gate(self):
+        async for (proto, addr), cid in self.in_queue:
+            res = True
+            for rule in self.rules:
+                if not await rule.handle(proto, addr):
+                    res = False
+                    break
+            await self.out_queue.append(res, cid)
+
+    async def execute(self, proto, addr):
+        slot = ReplySlot()
+        self.pending[id(slot)] = slot
+        await self.in_queue.append((proto, addr), id(slot))
+        return await slot.wait()
+
+
+async def accept_rate(execute, clients: int, accepts: int, peers: int) -> float:
+    remaining = accepts
+
+    async def client(n):
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            await execute(None, (f"10.0.{n % peers // 256}.{n % peers % 256}", 4000 + n))
+
+    ts = time.perf_counter()
+    async with trio.open_nursery() as nursery:
+        for n in range(clients):
+            nursery.start_soon(client, n)
+    return accepts / (time.perf_counter() - ts)
+
+
+async def main(clients: int = 512, accepts: int = 200_000, peers: int = 1024):
+    rules = [CheapRule(None) for _ in range(4)]
+
+    queued = QueuedGatehouse(rules, 128)
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(queued.router)
+        for _ in range(queued.gates):
+            nursery.start_soon(queued.gate)
+        before = await accept_rate(queued.execute, clients, accepts, peers)
+        nursery.cancel_scope.cancel()
+
+    consul = Consul()
+    gatehouse = Gatehouse(consul)
+    gatehouse.load_rules(rules)
+    after = await accept_rate(gatehouse.execute, clients, accepts, peers)
+
+    consul.config["gatehouse"]["verdict-ttl"] = 0
+    uncached = Gatehouse(consul)
+    uncached.load_rules(rules)
+    inline = await accept_rate(uncached.execute, clients, accepts, peers)
+
+    print(f"queued gates        {before:10.0f} accepts/s")
+    print(f"inline, no cache    {inline:10.0f} accepts/s ({inline / before:.1f}x)")
+    print(f"inline, verdicts    {after:10.0f} accepts/s ({after / before:.1f}x)")
+
+
+if __name__ == "__main__":
+    trio.run(main)
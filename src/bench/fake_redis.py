@@ -0,0 +1,176 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import argparse
+import hashlib
+import itertools
+
+import hiredis
+import trio
+
+from src.caching import INVALIDATION_CHANNEL
+from src.utils import resp_encode
+
+
+class FakeClient:
+    def __init__(self, stream: trio.SocketStream, cid: int):
+        self.stream = stream
+        self.id = cid
+        self.lock = trio.Lock()
+
+    async def send(self, data: bytes):
+        async with self.lock:
+            await self.stream.send_all(data)
+
+
+class FakeRedis:
+    """Just enough of Redis for the gateway to start and serve: strings, lists, scripts and client tracking.
+
+    Scripts are not run, every loaded script answers script_result. EVALSHA of a script that was never
+    loaded answers NOSCRIPT like Redis does. Tracking only supports the BCAST mode with REDIRECT that
+    InvalidationListener uses.
+    """
+
+    def __init__(self):
+        self.data: dict[str, object] = {"init": "init"}
+        self.ids = itertools.count(1)
+        self.clients: dict[int, FakeClient] = {}
+        self.tracking: dict[int, tuple[int, tuple[str, ...]]] = {}
+        self.touched: list[str] = []
+        self.flushed = False
+        self.scripts: set[str] = set()
+        self.script_result = 1
+
+    def call(self, client: FakeClient, command: list[str]) -> bytes:
+        name = command[0].upper()
+        args = command[1:]
+        if name == "PING":
+            return b"+PONG\r\n"
+        if name in ("AUTH", "SELECT"):
+            return b"+OK\r\n"
+        if name == "SUBSCRIBE":
+            return resp_encode(["subscribe", args[0], 1])
+        if name == "CLIENT":
+            return self.client(client, args)
+        if name == "GET":
+            value = self.data.get(args[0])
+            return resp_encode(value if isinstance(value, str) else None)
+        if name == "MGET":
+            return resp_encode([self.data.get(key) if isinstance(self.data.get(key), str) else None for key in args])
+        if name == "SET":
+            self.data[args[0]] = args[1]
+            self.touched.append(args[0])
+            return b"+OK\r\n"
+        if name == "DEL":
+            deleted = [key for key in args if self.data.pop(key, None) is not None]
+            self.touched.extend(deleted)
+            return resp_encode(len(deleted))
+        if name in ("FLUSHDB", "FLUSHALL"):
+            self.data.clear()
+            self.flushed = True
+            return b"+OK\r\n"
+        if name in ("LPUSH", "RPUSH"):
+            items = self.data.setdefault(args[0], [])
+            if name == "LPUSH":
+                items[:0] = reversed(args[1:])
+            else:
+                items.extend(args[1:])
+            self.touched.append(args[0])
+            return resp_encode(len(items))
+        if name == "LPOP":
+            items = self.data.get(args[0])
+            if not items:
+                return resp_encode(None)
+            self.touched.append(args[0])
+            if len(args) == 1:
+                return resp_encode(items.pop(0))
+            count = int(args[1])
+            res, self.data[args[0]] = items[:count], items[count:]
+            return resp_encode(res)
+        if name == "EVAL":
+            self.scripts.add(hashlib.sha1(args[0].encode()).hexdigest())
+            return resp_encode(self.script_result)
+        if name == "EVALSHA":
+            if args[0].lower() not in self.scripts:
+                return b"-NOSCRIPT No matching script. Please use EVAL.\r\n"
+            return resp_encode(self.script_result)
+        if name == "SCRIPT":
+            if args[0].upper() == "LOAD":
+                sha = hashlib.sha1(args[1].encode()).hexdigest()
+                self.scripts.add(sha)
+                return resp_encode(sha)
+            if args[0].upper() == "FLUSH":
+                self.scripts.clear()
+            return b"+OK\r\n"
+        return f"-ERR unknown command '{command[0]}'\r\n".encode()
+
+    def client(self, client: FakeClient, args: list[str]) -> bytes:
+        sub = args[0].upper() if args else ""
+        if sub == "ID":
+            return resp_encode(client.id)
+        if sub == "TRACKING":
+            options = [arg.upper() for arg in args[2:]]
+            if args[1].upper() != "ON":
+                self.tracking.pop(client.id, None)
+                return b"+OK\r\n"
+            if "BCAST" not in options or "REDIRECT" not in options:
+                return b"-ERR FakeRedis only tracks in BCAST mode with REDIRECT\r\n"
+            redirect = int(args[2 + options.index("REDIRECT") + 1])
+            prefixes = tuple(args[2 + i + 1] for i, option in enumerate(options) if option == "PREFIX")
+            self.tracking[client.id] = (redirect, prefixes)
+            return b"+OK\r\n"
+        return b"+OK\r\n"
+
+    async def invalidate(self, keys: list[str], flushed: bool):
+        for redirect, prefixes in list(self.tracking.values()):
+            target = self.clients.get(redirect)
+            if target is None:
+                continue
+            if flushed:
+                payload = None
+            else:
+                payload = [key for key in keys if not prefixes or key.startswith(prefixes)]
+                if not payload:
+                    continue
+            try:
+                await target.send(resp_encode(["message", INVALIDATION_CHANNEL, payload]))
+            except (trio.BrokenResourceError, trio.ClosedResourceError):
+                pass
+
+    async def handle(self, stream: trio.SocketStream):
+        cid = next(self.ids)
+        client = self.clients[cid] = FakeClient(stream, cid)
+        reader = hiredis.Reader(encoding="utf-8")
+        try:
+            async for chunk in stream:
+                reader.feed(chunk)
+                replies = []
+                while (command := reader.gets()) is not False:
+                    replies.append(self.call(client, command))
+                if replies:
+                    await client.send(b"".join(replies))
+                if self.touched or self.flushed:
+                    keys, self.touched, flushed, self.flushed = self.touched, [], self.flushed, False
+                    await self.invalidate(keys, flushed)
+        except (trio.BrokenResourceError, trio.ClosedResourceError):
+            pass
+        finally:
+            del self.clients[cid]
+            self.tracking.pop(cid, None)
+
+    async def serve(self, port: int, task_status=trio.TASK_STATUS_IGNORED):
+        await trio.serve_tcp(self.handle, port, host="127.0.0.1", task_status=task_status)
+
+
+def run(port: int):
+    try:
+        trio.run(FakeRedis().serve, port)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve an in-memory RESP stand-in for Redis.")
+    parser.add_argument("--port", type=int, default=6390)
+    run(parser.parse_args().port)
@@ -0,0 +1,92 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import time
+
+import trio
+
+from src.heartbeat import HeartbeatScheduler
+from src.session_structure import HeartbeatBase
+
+CONFIG = {
+    "heartbeat": {
+        "hb-init-interval": 500,
+        "hb-max-interval": 500,
+        "hb-min-interval": 500,
+        "hb-timeout": 500,
+    }
+}
+
+
+class IdleSession:
+    def __init__(self):
+        self.ht_base = HeartbeatBase(CONFIG)
+        self.heartbeat_seen = True
+        self.data_seen = False
+        self.heartbeat_future = trio.Event()
+        self.heartbeat_future.set()
+        self.acks = 0
+
+    def push(self, frame: bytes):
+        self.acks += 1
+        self.heartbeat_seen = True
+
+    def timeout(self):
+        raise AssertionError("idle session timed out")
+
+    async def task_loop(self):
+        while True:
+            await trio.sleep(self.ht_base.heartbeat_interval_in_seconds)
+            with trio.move_on_after(0.5):
+                await self.heartbeat_future.wait()
+                self.ht_base.heartbeat()
+                self.push(b"")
+
+
+class Consul:
+    config = CONFIG
+
+
+async def measure(sessions: list[IdleSession], start, window: float) -> tuple[float, float]:
+    for ses in sessions:
+        ses.acks = 0
+    async with trio.open_nursery() as nursery:
+        start(nursery)
+        await trio.sleep(1)
+        cpu, wall = time.process_time(), time.perf_counter()
+        await trio.sleep(window)
+        cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+        nursery.cancel_scope.cancel()
+    return cpu / wall, sum(ses.acks for ses in sessions) / wall
+
+
+async def run(count: int, window: float):
+    sessions = [IdleSession() for _ in range(count)]
+
+    def per_session(nursery):
+        for ses in sessions:
+            nursery.start_soon(ses.task_loop)
+
+    scheduler = HeartbeatScheduler(Consul())
+
+    def wheel(nursery):
+        for ses in sessions:
+            scheduler.register(ses)
+        nursery.start_soon(scheduler.run)
+
+    tasks, tasks_acks = await measure(sessions, per_session, window)
+    wheel_cost, wheel_acks = await measure(sessions, wheel, window)
+    print(
+        f"sessions={count:<7} task-per-session={tasks * 100:5.1f}% cpu {tasks_acks:9.0f} acks/s "
+        f"timer-wheel={wheel_cost * 100:5.1f}% cpu {wheel_acks:9.0f} acks/s"
+    )
+
+
+async def main():
+    for count in (10_000, 50_000, 100_000):
+        await run(count, 3)
+
+
+if __name__ == "__main__":
+    trio.run(main)
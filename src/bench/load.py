@@ -0,0 +1,475 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import argparse
+import collections
+import concurrent.futures
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tomllib
+
+import hiredis
+import trio
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROOT = os.path.dirname(SRC)
+os.chdir(SRC)
+
+from src.bench.fake_redis import run as run_fake_redis  # noqa: E402
+from src.metrics import Histogram  # noqa: E402
+
+NO_REPLY = frozenset(("HEARTBEAT",))
+
+
+def parse_mix(spec: str) -> list[tuple[tuple[str, ...], float]]:
+    mix = []
+    for part in spec.split(","):
+        command, _, weight = part.rpartition(":")
+        if not command:
+            command, weight = weight, "1"
+        mix.append((tuple(command.split()), float(weight)))
+    return mix
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(host: str, port: int, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def _toml_key(key: str) -> str:
+    return key if re.fullmatch(r"[A-Za-z0-9_-]+", key) else json.dumps(key)
+
+
+def _toml_value(value) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, float) and math.isinf(value):
+        return "inf" if value > 0 else "-inf"
+    return json.dumps(value)
+
+
+def dump_toml(config: dict, prefix: str = "") -> str:
+    lines = [f"[{prefix}]"] if prefix else []
+    tables = []
+    for key, value in config.items():
+        if isinstance(value, dict):
+            tables.append((f"{prefix}.{_toml_key(key)}" if prefix else _toml_key(key), value))
+        else:
+            lines.append(f"{_toml_key(key)} = {_toml_value(value)}")
+    return "\n".join(lines) + "\n" + "".join("\n" + dump_toml(value, name) for name, value in tables)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+class Stack:
+    """The gateway under test: an external --target, or a server subprocess backed by redis-server or FakeRedis."""
+
+    def __init__(self, target: str = "", redis_url: str = "", server_workers: int = 1, capture: str = ""):
+        self.target = target
+        self.redis_url = redis_url
+        self.server_workers = server_workers
+        self.capture = capture
+        self.host = "127.0.0.1"
+        self.port = 0
+        self.processes: list = []
+        self.config_path = ""
+
+    def __enter__(self):
+        if self.target:
+            host, _, port = self.target.rpartition(":")
+            self.host, self.port = host or "127.0.0.1", int(port)
+            return self
+        redis_url = self.redis_url
+        if not redis_url:
+            redis_port = free_port()
+            fake = multiprocessing.Process(target=run_fake_redis, args=(redis_port,), daemon=True)
+            fake.start()
+            self.processes.append(fake)
+            wait_for_port("127.0.0.1", redis_port)
+            redis_url = f"redis://127.0.0.1:{redis_port}/0"
+        with open(os.path.join(ROOT, "clousocket.toml.example"), "rb") as f:
+            config = tomllib.load(f)
+        self.port = free_port()
+        config["network"].update(host=self.host, port=self.port, workers=self.server_workers)
+        config["redis"]["url"] = redis_url
+        config["sentry"].update(dsn="", **{"traces-sample-rate": 0.0, "profiles-sample-rate": 0.0})
+        if self.capture:
+            config.setdefault("capture", {}).update(enabled=True, path=os.path.abspath(self.capture))
+        fd, self.config_path = tempfile.mkstemp(suffix=".toml", prefix="clousocket-bench-")
+        with os.fdopen(fd, "w") as f:
+            f.write(dump_toml(config))
+        env = dict(os.environ, CLOUSOCKET_CONFIG=self.config_path)
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, (ROOT, env.get("PYTHONPATH"))))
+        self.processes.append(subprocess.Popen([sys.executable, "server.py"], cwd=SRC, env=env))
+        wait_for_port(self.host, self.port)
+        return self
+
+    def __exit__(self, *exc):
+        for process in reversed(self.processes):
+            process.terminate()
+        for process in self.processes:
+            if isinstance(process, subprocess.Popen):
+                process.wait(10)
+            else:
+                process.join(10)
+        if self.config_path:
+            os.unlink(self.config_path)
+        return False
+
+
+class Tally:
+    def __init__(self, warmup_until: int):
+        self.warmup_until = warmup_until
+        self.latency = Histogram()
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+        self.connect_errors = 0
+        self.heartbeat_acks = 0
+        self.heartbeat_timeouts = 0
+
+    def record(self, stamp: int, now: int, error: bool):
+        if stamp < self.warmup_until:
+            return
+        self.received += 1
+        self.errors += error
+        self.latency.record(now - stamp)
+
+    def result(self) -> dict:
+        return {key: value for key, value in vars(self).items() if key != "warmup_until"}
+
+
+class Connection:
+    def __init__(self, stream: trio.SocketStream, tally: Tally, depth: int):
+        self.stream = stream
+        self.tally = tally
+        self.reader = hiredis.Reader()
+        self.stamps: collections.deque[int] = collections.deque()
+        self.window = trio.Semaphore(depth)
+        self.interval = 0.0
+
+    async def send_raw(self, payload: bytes, replies: int, stamp: int):
+        self.stamps.extend(itertools.repeat(stamp, replies))
+        if stamp >= self.tally.warmup_until:
+            self.tally.sent += replies
+        await self.stream.send_all(payload)
+
+    async def send(self, frames: list[tuple[bytes, bool]], stamp: int):
+        payload = []
+        for frame, replies in frames:
+            if replies:
+                self.stamps.append(stamp)
+                self.tally.sent += stamp >= self.tally.warmup_until
+            payload.append(frame)
+        await self.stream.send_all(b"".join(payload))
+
+    async def receive(self):
+        async for chunk in self.stream:
+            self.reader.feed(chunk)
+            now = time.perf_counter_ns()
+            while (reply := self.reader.gets()) is not False:
+                if isinstance(reply, list) and reply and reply[0] == b"HEARTBEAT":
+                    if reply[1] == b"ACK":
+                        self.tally.heartbeat_acks += 1
+                        self.interval = float(reply[2]) / 1000
+                    else:
+                        self.tally.heartbeat_timeouts += 1
+                    continue
+                if not self.stamps:
+                    continue
+                self.tally.record(self.stamps.popleft(), now, isinstance(reply, hiredis.ReplyError))
+                self.window.release()
+
+
+class Workload:
+    def __init__(self, mix: list[tuple[tuple[str, ...], float]], seed: int):
+        self.random = random.Random(seed)
+        self.commands = [hiredis.pack_command(command) for command, _ in mix]
+        self.replies = [command[0].upper() not in NO_REPLY for command, _ in mix]
+        self.weights = list(itertools.accumulate(weight for _, weight in mix))
+
+    def pick(self) -> tuple[bytes, bool]:
+        index = self.random.choices(range(len(self.commands)), cum_weights=self.weights)[0]
+        return self.commands[index], self.replies[index]
+
+
+async def drive(conn: Connection, workload: Workload, rate: float, deadline: float):
+    if rate <= 0:
+        while trio.current_time() < deadline:
+            await conn.window.acquire()
+            frames = [workload.pick()]
+            while True:
+                try:
+                    conn.window.acquire_nowait()
+                except trio.WouldBlock:
+                    break
+                frames.append(workload.pick())
+            for _, replies in frames:
+                if not replies:
+                    conn.window.release()
+            await conn.send(frames, time.perf_counter_ns())
+        return
+    offset = time.perf_counter_ns() - int(trio.current_time() * 1e9)
+    arrival = trio.current_time()
+    while arrival < deadline:
+        arrival += workload.random.expovariate(rate)
+        await trio.sleep_until(arrival)
+        frame = workload.pick()
+        if frame[1]:
+            await conn.window.acquire()
+        await conn.send([frame], int(arrival * 1e9) + offset)
+
+
+async def pipeline_client(host, port, tally, workload, depth, rate, deadline):
+    try:
+        stream = await trio.open_tcp_stream(host, port)
+    except OSError:
+        tally.connect_errors += 1
+        return
+    conn = Connection(stream, tally, depth)
+    async with stream:
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(conn.receive)
+            await drive(conn, workload, rate, deadline)
+            with trio.move_on_after(5):
+                while conn.stamps:
+                    await conn.window.acquire()
+            nursery.cancel_scope.cancel()
+
+
+async def storm_client(host, port, tally, workload, deadline):
+    while trio.current_time() < deadline:
+        stamp = time.perf_counter_ns()
+        try:
+            stream = await trio.open_tcp_stream(host, port)
+        except OSError:
+            tally.connect_errors += 1
+            continue
+        async with stream:
+            frame, _ = workload.pick()
+            try:
+                await stream.send_all(frame)
+                reply = await stream.receive_some()
+            except trio.BrokenResourceError:
+                reply = b""
+            tally.sent += stamp >= tally.warmup_until
+            tally.record(stamp, time.perf_counter_ns(), not reply or reply.startswith(b"-"))
+
+
+async def idle_client(host, port, tally, interval, deadline):
+    try:
+        stream = await trio.open_tcp_stream(host, port)
+    except OSError:
+        tally.connect_errors += 1
+        return
+    conn = Connection(stream, tally, 1)
+    conn.interval = interval
+    async with stream:
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(conn.receive)
+            beat = hiredis.pack_command(("HEARTBEAT",))
+            while trio.current_time() < deadline:
+                try:
+                    await stream.send_all(beat)
+                except trio.BrokenResourceError:
+                    break
+                await trio.sleep(min(conn.interval / 2, deadline - trio.current_time()))
+            nursery.cancel_scope.cancel()
+
+
+async def run_worker(options: dict, connections: int, rate: float, seed: int) -> dict:
+    host, port = options["host"], options["port"]
+    start = trio.current_time()
+    deadline = start + options["warmup"] + options["duration"]
+    tally = Tally(time.perf_counter_ns() + int(options["warmup"] * 1e9))
+    mix = parse_mix(options["mix"])
+    scenario = options["scenario"]
+    async with trio.open_nursery() as nursery:
+        for n in range(connections):
+            workload = Workload(mix, seed * 100_003 + n)
+            if scenario == "storm":
+                nursery.start_soon(storm_client, host, port, tally, workload, deadline)
+            elif scenario == "idle":
+                nursery.start_soon(idle_client, host, port, tally, options["heartbeat_interval"], deadline)
+            else:
+                nursery.start_soon(
+                    pipeline_client, host, port, tally, workload, options["depth"], rate / connections, deadline
+                )
+            if options["ramp"]:
+                await trio.sleep(options["ramp"] / connections)
+        if scenario == "idle":
+            probe = Workload(mix, seed)
+            nursery.start_soon(pipeline_client, host, port, tally, probe, 1, 0, deadline)
+    return tally.result()
+
+
+def worker_entry(options: dict, connections: int, rate: float, seed: int) -> dict:
+    return trio.run(run_worker, options, connections, rate, seed)
+
+
+def summarize(scenario: str, params: dict, results: list[dict], duration: float) -> dict:
+    latency = Histogram()
+    totals = collections.Counter()
+    for res in results:
+        latency.merge(res.pop("latency"))
+        totals.update(res)
+    return {
+        "scenario"  : scenario,
+        "commit"    : git_commit(),
+        "timestamp" : int(time.time()),
+        "params"    : params,
+        "duration_s": duration,
+        "throughput": totals["received"] / duration if duration else 0.0,
+        **dict(totals),
+        "latency_ms": {
+            "mean": latency.mean / 1e6,
+            "p50" : latency.percentile(50) / 1e6,
+            "p99" : latency.percentile(99) / 1e6,
+            "p999": latency.percentile(99.9) / 1e6,
+            "max" : latency.max / 1e6,
+        },
+    }
+
+
+def compare(report: dict, baseline: dict) -> list[str]:
+    def delta(new, old):
+        return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+    lines = [f"vs {baseline.get('commit', '?')} ({baseline.get('scenario', '?')})"]
+    lines.append(
+        f"  throughput {baseline['throughput']:12.1f} -> {report['throughput']:12.1f} "
+        f"{delta(report['throughput'], baseline['throughput'])}"
+    )
+    for key in ("p50", "p99", "p999"):
+        old, new = baseline["latency_ms"][key], report["latency_ms"][key]
+        lines.append(f"  {key:<10} {old:10.3f}ms -> {new:10.3f}ms {delta(new, old)}")
+    return lines
+
+
+def print_report(report: dict):
+    latency = report["latency_ms"]
+    print(
+        f"{report['scenario']}: {report.get('received', 0)} replies in {report['duration_s']:.1f}s "
+        f"= {report['throughput']:.0f}/s, errors {report.get('errors', 0)}, "
+        f"connect errors {report.get('connect_errors', 0)}"
+    )
+    print(
+        f"  latency mean {latency['mean']:.3f}ms p50 {latency['p50']:.3f}ms p99 {latency['p99']:.3f}ms "
+        f"p999 {latency['p999']:.3f}ms max {latency['max']:.3f}ms"
+    )
+    if report["scenario"] == "idle":
+        print(f"  heartbeat acks {report.get('heartbeat_acks', 0)}, timeouts {report.get('heartbeat_timeouts', 0)}")
+
+
+SCENARIOS = {
+    "pipeline": {},
+    "storm"   : {"connections": 256, "mix": "slowlog len"},
+    "idle"    : {"connections": 5000, "mix": "slowlog len"},
+    "payload" : {"connections": 32, "depth": 4},
+}
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Drive RESP load against Clousocket and report latency.")
+    parser.add_argument("scenario", choices=SCENARIOS, nargs="?", default="pipeline")
+    parser.add_argument("--target", default="", help="host:port of a running server, otherwise one is started")
+    parser.add_argument("--redis-url", default="", help="redis-server for the started server, default FakeRedis")
+    parser.add_argument("--server-workers", type=int, default=1)
+    parser.add_argument("--procs", type=int, default=1, help="load generator processes")
+    parser.add_argument("--connections", type=int, default=64)
+    parser.add_argument("--depth", type=int, default=16, help="pipelined requests in flight per connection")
+    parser.add_argument("--mix", default="slowlog len:6,slowlog get 1:3,heartbeat:1",
+                        help="weighted commands, e.g. 'slowlog len:8,info server:1', INFO renders every metric and "
+                             "dominates any mix it is in")
+    parser.add_argument("--rate", type=float, default=0, help="open-loop Poisson arrivals per second, 0 = closed loop")
+    parser.add_argument("--payload-size", type=int, default=64 * 1024, help="argument bytes in the payload scenario")
+    parser.add_argument("--heartbeat-interval", type=float, default=0.25, help="seconds between idle heartbeats")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--warmup", type=float, default=1)
+    parser.add_argument("--ramp", type=float, default=0, help="seconds over which connections are opened")
+    parser.add_argument("--capture", default="", help="have the started server record its traffic here")
+    parser.add_argument("--output", default="", help="write the JSON report here")
+    parser.add_argument("--baseline", default="", help="JSON report to compare against")
+    return parser
+
+
+def run(args: argparse.Namespace, host: str, port: int) -> dict:
+    options = {
+        "scenario"          : args.scenario,
+        "host"              : host,
+        "port"              : port,
+        "mix"               : args.mix,
+        "depth"             : args.depth,
+        "warmup"            : args.warmup,
+        "duration"          : args.duration,
+        "ramp"              : args.ramp,
+        "heartbeat_interval": args.heartbeat_interval,
+    }
+    if args.scenario == "payload":
+        options["mix"] = f"info {'x' * args.payload_size}"
+    shares = [args.connections // args.procs + (i < args.connections % args.procs) for i in range(args.procs)]
+    if args.procs == 1:
+        results = [worker_entry(options, shares[0], args.rate, 0)]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(args.procs) as pool:
+            futures = [
+                pool.submit(worker_entry, options, share, args.rate * share / args.connections, i)
+                for i, share in enumerate(shares) if share
+            ]
+            results = [future.result() for future in futures]
+    params = {
+        key: value for key, value in vars(args).items() if key not in ("output", "baseline", "target", "capture")
+    }
+    return summarize(args.scenario, params, results, args.duration)
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    parser.set_defaults(**SCENARIOS[args.scenario])
+    args = parser.parse_args(argv)
+    with Stack(args.target, args.redis_url, args.server_workers, args.capture) as stack:
+        report = run(args, stack.host, stack.port)
+    print_report(report)
+    if args.baseline:
+        with open(args.baseline) as f:
+            print("\n".join(compare(report, json.load(f))))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import argparse
+import json
+import time
+
+import hiredis
+import trio
+
+from src.bench.load import Connection, Stack, Tally, compare, print_report, summarize
+from src.capture import CLOSE, DATA, OPEN, read_capture
+
+
+class ReplaySession:
+    def __init__(self, opened: int):
+        self.opened = opened
+        self.closed = 0
+        self.chunks: list[tuple[int, bytes, int]] = []
+
+
+def load_sessions(paths: list[str]) -> list[ReplaySession]:
+    sessions: dict[tuple[int, int], ReplaySession] = {}
+    readers: dict[tuple[int, int], hiredis.Reader] = {}
+    for n, path in enumerate(paths):
+        for timestamp, sid, kind, data in read_capture(path):
+            key = (n, sid)
+            session = sessions.get(key)
+            if session is None or kind == OPEN:
+                session = sessions[key] = ReplaySession(timestamp)
+                readers[key] = hiredis.Reader()
+            if kind == DATA:
+                reader = readers[key]
+                reader.feed(data)
+                replies = sum(
+                    not (isinstance(frame, list) and frame and frame[0].upper() == b"HEARTBEAT")
+                    for frame in iter(reader.gets, False)
+                )
+                session.chunks.append((timestamp, data, replies))
+            elif kind == CLOSE:
+                session.closed = timestamp
+    return sorted(sessions.values(), key=lambda session: session.opened)
+
+
+async def replay_session(host, port, tally: Tally, session: ReplaySession, at, offset: int):
+    await trio.sleep_until(at(session.opened))
+    try:
+        stream = await trio.open_tcp_stream(host, port)
+    except OSError:
+        tally.connect_errors += 1
+        return
+    conn = Connection(stream, tally, 1)
+    async with stream:
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(conn.receive)
+            try:
+                for timestamp, data, replies in session.chunks:
+                    due = at(timestamp)
+                    await trio.sleep_until(due)
+                    await conn.send_raw(data, replies, int(due * 1e9) + offset)
+            except trio.BrokenResourceError:
+                tally.errors += len(conn.stamps)
+                nursery.cancel_scope.cancel()
+                return
+            if session.closed:
+                await trio.sleep_until(at(session.closed))
+            with trio.move_on_after(5):
+                while conn.stamps:
+                    await conn.window.acquire()
+            tally.errors += len(conn.stamps)
+            nursery.cancel_scope.cancel()
+
+
+async def replay(host: str, port: int, sessions: list[ReplaySession], speed: float) -> tuple[dict, float]:
+    tally = Tally(0)
+    origin = sessions[0].opened
+    start = trio.current_time()
+    offset = time.perf_counter_ns() - int(start * 1e9)
+
+    def at(timestamp: int) -> float:
+        return start + (timestamp - origin) / 1e9 / speed
+
+    async with trio.open_nursery() as nursery:
+        for session in sessions:
+            nursery.start_soon(replay_session, host, port, tally, session, at, offset)
+    return tally.result(), trio.current_time() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Re-drive captured Clousocket traffic and report latency.")
+    parser.add_argument("captures", nargs="+", help="capture logs, one per worker")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed multiplier")
+    parser.add_argument("--target", default="", help="host:port of a running server, otherwise one is started")
+    parser.add_argument("--redis-url", default="", help="redis-server for the started server, default FakeRedis")
+    parser.add_argument("--server-workers", type=int, default=1)
+    parser.add_argument("--output", default="", help="write the JSON report here")
+    parser.add_argument("--baseline", default="", help="JSON report to compare against")
+    args = parser.parse_args(argv)
+
+    sessions = load_sessions(args.captures)
+    if not sessions:
+        parser.error("the capture holds no sessions")
+    with Stack(args.target, args.redis_url, args.server_workers) as stack:
+        result, duration = trio.run(replay, stack.host, stack.port, sessions, args.speed)
+    params = {
+        "captures"      : args.captures,
+        "speed"         : args.speed,
+        "sessions"      : len(sessions),
+        "server_workers": args.server_workers,
+        "redis_url"     : args.redis_url,
+    }
+    report = summarize("replay", params, [result], duration)
+    print_report(report)
+    if args.baseline:
+        with open(args.baseline) as f:
+            print("\n".join(compare(report, json.load(f))))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
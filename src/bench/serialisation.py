@@ -0,0 +1,54 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import os
+import timeit
+
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.middleware.serialisation import Data, End, Serialiser, SubCommand  # noqa: E402
+
+
+def walk_chain(data):
+    raw_data = data
+    if isinstance(data.next, SubCommand):
+        raw_data = raw_data.next
+    args = []
+    while not isinstance(raw_data.next, End):
+        if isinstance(raw_data.next, Data):
+            args.append(raw_data.next.this)
+        raw_data = raw_data.next
+    return args
+
+
+def main(number: int = 20000):
+    s = Serialiser()
+    cached = Serialiser.convert_request
+    while not hasattr(cached, "cache_clear"):
+        cached = cached.__wrapped__
+
+    def convert(*request):
+        cached.cache_clear()
+        return s.convert_request(*request)
+
+    # No shipped command takes a variable argument list, so register one to time parsing against argument count.
+    s._register_command("echo", None, "echo", [{"name": "data", "required": False, "variadic": True}])
+    requests = {"heartbeat ack": ("HEARTBEAT", "ack", "1"), "slowlog get": ("SLOWLOG", "GET", "10"),
+                "slowlog len": ("SLOWLOG", "LEN")}
+    for argc in (0, 4, 32, 256):
+        requests[f"echo args={argc}"] = ("ECHO", *(str(i) for i in range(argc)))
+
+    for name, request in requests.items():
+        req = s.parse(*request)
+        assert req.error is None and req.spec is not None, f"{name} does not parse: {req.error}"
+        linked = timeit.timeit(lambda: walk_chain(convert(*request)), number=number)
+        flat = timeit.timeit(lambda: s.parse(*request).args, number=number)
+        print(
+            f"{name:<16} linked={linked / number * 1e6:9.2f}us "
+            f"flat={flat / number * 1e6:7.2f}us speedup={linked / flat:6.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
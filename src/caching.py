@@ -0,0 +1,187 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import time
+import typing
+import urllib.parse
+
+import cachebox
+import hiredis
+import sentry_sdk
+import trio
+
+INVALIDATION_CHANNEL = "__redis__:invalidate"
+
+# Key positions of write commands as (first, last, step), last -1 meaning the final argument.
+WRITE_KEYS: dict[str, tuple[int, int, int]] = {
+    **dict.fromkeys((
+        "SET", "SETNX", "SETEX", "PSETEX", "GETSET", "GETDEL", "GETEX", "APPEND", "SETRANGE", "SETBIT", "BITFIELD",
+        "RESTORE", "MOVE",
+        "INCR", "INCRBY", "INCRBYFLOAT", "DECR", "DECRBY",
+        "EXPIRE", "PEXPIRE", "EXPIREAT", "PEXPIREAT", "PERSIST",
+        "HSET", "HSETNX", "HMSET", "HDEL", "HINCRBY", "HINCRBYFLOAT",
+        "LPUSH", "RPUSH", "LPUSHX", "RPUSHX", "LPOP", "RPOP", "LSET", "LREM", "LTRIM", "LINSERT",
+        "SADD", "SREM", "SPOP", "ZADD", "ZREM", "ZINCRBY", "ZPOPMIN", "ZPOPMAX",
+    ), (1, 1, 1)),
+    **dict.fromkeys(("DEL", "UNLINK"), (1, -1, 1)),
+    **dict.fromkeys(("MSET", "MSETNX"), (1, -1, 2)),
+    **dict.fromkeys(("RENAME", "RENAMENX", "COPY", "RPOPLPUSH", "LMOVE", "SMOVE"), (1, 2, 1)),
+    "BITOP": (2, 2, 1),
+}
+SCRIPT_COMMANDS = frozenset(("EVAL", "EVALSHA", "FCALL"))
+FLUSH_COMMANDS = frozenset(("FLUSHDB", "FLUSHALL"))
+
+
+def written_keys(inp: tuple) -> typing.Optional[tuple]:
+    """Keys a command may modify: () for reads and unknown commands, None when the whole keyspace goes."""
+    name = inp[0].upper()
+    spec = WRITE_KEYS.get(name)
+    if spec is not None:
+        first, last, step = spec
+        return inp[first:len(inp) if last < 0 else last + 1:step]
+    if name in SCRIPT_COMMANDS:
+        try:
+            return inp[3:3 + int(inp[2])]
+        except (IndexError, ValueError):
+            return ()
+    if name in FLUSH_COMMANDS:
+        return None
+    return ()
+
+
+class ClientCache:
+    def __init__(self, cache: cachebox.LRUCache, config: dict):
+        self.cache = cache
+        self.mode = config.get("mode", "ttl")
+        self.default_ttl = float(config.get("ttl", 0))
+        self.prefixes: list[tuple[str, float]] = sorted(
+            ((prefix, float(ttl)) for prefix, ttl in config.get("prefixes", {}).items()),
+            key=lambda item: len(item[0]),
+            reverse=True
+        )
+        self.fills: dict[str, list[int]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.default_ttl > 0 or any(ttl > 0 for _, ttl in self.prefixes)
+
+    def ttl(self, key: str) -> float:
+        for prefix, ttl in self.prefixes:
+            if key.startswith(prefix):
+                return ttl
+        return self.default_ttl
+
+    def lookup(self, key):
+        entry = self.cache.get(key, None)
+        if entry is not None:
+            value, expires = entry
+            if expires > time.monotonic():
+                self.hits += 1
+                return True, value
+            self.cache.pop(key, None)
+        self.misses += 1
+        return False, None
+
+    def begin(self, key) -> int:
+        fill = self.fills.get(key)
+        if fill is None:
+            fill = self.fills[key] = [0, 0]
+        fill[0] += 1
+        return fill[1]
+
+    def release(self, key):
+        fill = self.fills[key]
+        fill[0] -= 1
+        if not fill[0]:
+            del self.fills[key]
+
+    def store(self, key, value, version: int):
+        if self.fills[key][1] != version:
+            return
+        ttl = self.ttl(key)
+        if ttl <= 0:
+            return
+        if key not in self.cache and len(self.cache) >= self.cache.maxsize:
+            self.evictions += 1
+        self.cache.insert(key, (value, time.monotonic() + ttl))
+
+    def invalidate(self, *keys):
+        for key in keys:
+            fill = self.fills.get(key)
+            if fill is not None:
+                fill[1] += 1
+            if self.cache.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def flush(self):
+        for fill in self.fills.values():
+            fill[1] += 1
+        self.invalidations += len(self.cache)
+        self.cache.clear()
+
+
+class InvalidationListener:
+    def __init__(self, cache: ClientCache, url: str):
+        self.cache = cache
+        self.url = urllib.parse.urlsplit(url)
+        self.prefixes = [prefix for prefix, ttl in cache.prefixes if ttl > 0]
+        if cache.default_ttl > 0:
+            self.prefixes = []
+
+    async def _open(self) -> tuple[trio.SocketStream, hiredis.Reader]:
+        stream = await trio.open_tcp_stream(self.url.hostname or "localhost", self.url.port or 6379)
+        reader = hiredis.Reader(encoding="utf-8", errors="surrogateescape")
+        if self.url.password:
+            auth = ("AUTH", self.url.username, self.url.password) if self.url.username else \
+                ("AUTH", self.url.password)
+            await self._call(stream, reader, *auth)
+        return stream, reader
+
+    @staticmethod
+    async def _reply(stream: trio.SocketStream, reader: hiredis.Reader):
+        while (res := reader.gets()) is False:
+            data = await stream.receive_some()
+            if not data:
+                raise trio.BrokenResourceError("Redis closed the invalidation connection")
+            reader.feed(data)
+        if isinstance(res, hiredis.ReplyError):
+            raise res
+        return res
+
+    async def _call(self, stream: trio.SocketStream, reader: hiredis.Reader, *command):
+        await stream.send_all(hiredis.pack_command(command))
+        return await self._reply(stream, reader)
+
+    async def listen(self):
+        subscriber, sub_reader = await self._open()
+        tracker, tracker_reader = await self._open()
+        async with subscriber, tracker:
+            client_id = await self._call(subscriber, sub_reader, "CLIENT", "ID")
+            await self._call(subscriber, sub_reader, "SUBSCRIBE", INVALIDATION_CHANNEL)
+            command = ["CLIENT", "TRACKING", "ON", "REDIRECT", str(client_id), "BCAST"]
+            for prefix in self.prefixes:
+                command += ["PREFIX", prefix]
+            await self._call(tracker, tracker_reader, *command)
+            self.cache.flush()
+            while True:
+                kind, channel, keys = await self._reply(subscriber, sub_reader)
+                if kind != "message" or channel != INVALIDATION_CHANNEL:
+                    continue
+                if keys is None:
+                    self.cache.flush()
+                else:
+                    self.cache.invalidate(*keys)
+
+    async def starter(self):
+        while True:
+            try:
+                await self.listen()
+            except (OSError, trio.BrokenResourceError, hiredis.HiredisError) as err:
+                sentry_sdk.capture_exception(err)
+            self.cache.flush()
+            await trio.sleep(1)
@@ -0,0 +1,82 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import itertools
+import struct
+import time
+import typing
+
+import sentry_sdk
+import trio
+
+MAGIC = b"CLSCAP1\n"
+RECORD = struct.Struct("<QIBI")
+
+OPEN = 0
+DATA = 1
+CLOSE = 2
+
+
+class TrafficRecorder:
+    def __init__(self, config: dict, limiter: trio.CapacityLimiter):
+        self.path = config.get("path", "./capture.bin")
+        self.max_bytes = int(config.get("max-bytes", 0))
+        self.flush_interval = float(config.get("flush-interval", 100)) / 1000
+        self.limiter = limiter
+        self.ids = itertools.count(1)
+        self.buffer = bytearray()
+        self.written = 0
+        self.recording = True
+        self.dropped = 0
+
+    def open(self) -> int:
+        sid = next(self.ids)
+        self.record(sid, OPEN, b"")
+        return sid
+
+    def record(self, sid: int, kind: int, data: bytes):
+        if not self.recording:
+            return
+        self.buffer += RECORD.pack(time.time_ns(), sid, kind, len(data))
+        self.buffer += data
+        if self.max_bytes and self.written + len(self.buffer) >= self.max_bytes:
+            self.recording = False
+
+    def _write(self, file: typing.BinaryIO, data: bytes):
+        file.write(data)
+        file.flush()
+
+    async def flusher(self):
+        with open(self.path, "ab") as file:
+            if file.tell() == 0:
+                file.write(MAGIC)
+            while True:
+                await trio.sleep(self.flush_interval)
+                if not self.buffer:
+                    if not self.recording:
+                        return
+                    continue
+                data, self.buffer = bytes(self.buffer), bytearray()
+                try:
+                    await trio.to_thread.run_sync(self._write, file, data, limiter=self.limiter)
+                except OSError as err:
+                    sentry_sdk.capture_exception(err)
+                    self.recording = False
+                    self.dropped += len(data)
+                    return
+                self.written += len(data)
+
+
+def read_capture(path: str) -> typing.Iterator[tuple[int, int, int, bytes]]:
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a Clousocket capture")
+        while header := file.read(RECORD.size):
+            if len(header) < RECORD.size:
+                return
+            timestamp, sid, kind, length = RECORD.unpack(header)
+            data = file.read(length)
+            if len(data) < length:
+                return
+            yield timestamp, sid, kind, data
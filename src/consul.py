@@ -2,6 +2,8 @@
 #  Copyright (C) 2024-present Lovania
 #
 
+import os
+import time
 import tomllib
 import typing
 import uuid
@@ -13,17 +15,35 @@ from sentry_sdk.integrations.asyncio import AsyncioIntegration
 from sentry_sdk.integrations.socket import SocketIntegration
 
 from src import red_db, session_structure
-from src.errors import Execution
+from src.capture import TrafficRecorder
+from src.errors import Execution, OverloadError
+from src.exposition import MetricsEndpoint, render_info
 from src.gatehouse.gatehouse import Gatehouse
+from src.handling import Handler
+from src.heartbeat import HeartbeatScheduler
 from src.middleware.middleware import Middleware
+from src.metrics import Metrics
 from src.middleware.serialisation import ReaderMIL, SerialiserMIL
+from src.profiler import LoopProfiler, SlowStep
+from src.utils import resp_bulk, resp_encode, resp_error
+
+CONFIG_PATH = os.environ.get("CLOUSOCKET_CONFIG", "../clousocket.toml")
+REFUSAL_TIMEOUT = 0.1  # seconds a refused peer gets to take the BUSY reply
+
+
+def load_config(path: str = CONFIG_PATH) -> dict:
+    with open(path, "rb") as f:
+        return tomllib.load(f)
 
 
 class SupremeConsul:
 
-    def __init__(self):
+    def __init__(self, worker_id: typing.Optional[int] = None, reports=None):
+        self.worker_id = worker_id
+        self.reports = reports
         self.config: dict = {}
         self.sessions: dict[str, session_structure.Session] = {}
+        self.recorder: typing.Optional[TrafficRecorder] = None
         self.consulars: list[Consular] = []
         self.nid = uuid.uuid1()
         self.db: typing.Optional[red_db.RedisTPCS] = None
@@ -32,12 +52,14 @@ class SupremeConsul:
         self.cache: typing.Optional[cachebox.Cache] = None
 
     async def __aenter__(self):
-        with open("../clousocket.toml", "rb") as f:
-            self.config = tomllib.load(f)
+        self.config = load_config()
         self.limiter = trio.CapacityLimiter(int(self.config["threading"]["thread-limit"]))
+        self.native_sessions = bool(self.config["threading"].get("native-sessions", True))
         self.host = self.config["network"]["host"]
         self.port = int(self.config["network"]["port"])
+        self.workers = int(self.config["network"].get("workers", 1))
 
+        self.metrics = Metrics(float(self.config["sentry"]["traces-sample-rate"]))
         sentry_sdk.init(
             dsn=self.config["sentry"]["dsn"],
             traces_sample_rate=float(self.config["sentry"]["traces-sample-rate"]),
@@ -48,20 +70,39 @@ class SupremeConsul:
 
         async with trio.open_nursery() as nursery:
             self.nursery = nursery
+            self.cache = cachebox.LRUCache(self.config["caching"]["size"])
             self.db = red_db.RedisTPCS(self)
             self.nursery.start_soon(self.db.starter)
             self.wt = WatchTower(self)
             self.gh = Gatehouse(self)
-            self.nursery.start_soon(self.gh.starter)
-            self.cache = cachebox.LRUCache(self.config["caching"]["size"])
-            self.middleware = Middleware(ReaderMIL(), SerialiserMIL())
+            self.serialiser = SerialiserMIL()
+            self.middleware = Middleware(ReaderMIL(), self.serialiser)
+            self.handler = Handler(self)
+            self.heartbeats = HeartbeatScheduler(self)
+            trio.lowlevel.spawn_system_task(self.heartbeats.run)
+            self.handler.add_command("info", self.wt.info)
+            self.handler.add_command("slowlog_get", self.wt.slowlog_get)
+            self.handler.add_command("slowlog_len", self.wt.slowlog_len)
+            self.handler.add_command("slowlog_reset", self.wt.slowlog_reset)
             trio.lowlevel.spawn_system_task(self.wt.watchman)
+            capture = self.config.get("capture", {})
+            if bool(capture.get("enabled", False)):
+                if self.worker_id is not None:
+                    capture = dict(capture, path=f"{capture.get('path', './capture.bin')}.{self.worker_id}")
+                self.recorder = TrafficRecorder(capture, self.limiter)
+                trio.lowlevel.spawn_system_task(self.recorder.flusher)
+            http_port = int(self.config.get("metrics", {}).get("http-port", 0))
+            if http_port:
+                endpoint = MetricsEndpoint(
+                    self, self.config["metrics"].get("http-host", self.host), http_port + (self.worker_id or 0)
+                )
+                trio.lowlevel.spawn_system_task(endpoint.serve)
 
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self.db.out_queue.s_channel.aclose()
-        await self.db.out_queue.r_channel.aclose()
+        if self.wt.profiler is not None:
+            self.wt.profiler.close()
         await self.db.in_queue.s_channel.aclose()
         await self.db.in_queue.r_channel.aclose()
         sentry_sdk.get_client().close()
@@ -78,29 +119,134 @@ class SupremeConsul:
         return self
 
     async def create_session(self, sck: trio.SocketStream):
+        try:
+            res = await self.gh.execute(sck, sck.socket.getpeername())
+        except OverloadError:
+            with trio.move_on_after(REFUSAL_TIMEOUT):
+                try:
+                    await sck.send_all(resp_error("BUSY", "server is overloaded, try again later"))
+                except (trio.BrokenResourceError, trio.ClosedResourceError):
+                    pass
+            res = False
+        if not res:
+            self.metrics.incr("connections_refused")
+            try:
+                await sck.aclose()
+            except (trio.BrokenResourceError, trio.ClosedResourceError):
+                pass
+            return None
+        self.metrics.incr("connections_accepted")
         cnslr = Consular(self)
         ses = session_structure.Session(sck, self, cnslr)
         sesid = id(ses)
         self.sessions[str(uuid.uuid3(self.nid, f"{sesid}"))] = ses
         self.ids[id(cnslr)] = sesid
-        res = await self.gh.execute(sck, sck.socket.getpeername())
-        if not res:
-            await sck.aclose()
-            return None
-        await trio.to_thread.run_sync(ses.between_callback, limiter=self.limiter)
+        if self.native_sessions:
+            await ses.basis()
+        else:
+            await trio.to_thread.run_sync(ses.between_callback, limiter=self.limiter)
 
 
 class WatchTower:
     def __init__(self, consul: SupremeConsul):
         self.consul = consul
+        config = consul.config.get("metrics", {})
+        self.export_interval = float(config.get("export-interval", 2000)) / 1000
+        self.lag_interval = float(config.get("lag-interval", 100)) / 1000
+        self.started = time.monotonic()
+        self.counts: dict[str, int] = {}
+        self.rates: dict[str, float] = {}
+        self.summaries: dict[str, float] = {}
+        self.summarised: typing.Optional[float] = None
+        self.profiler: typing.Optional[LoopProfiler] = None
+        if bool(config.get("profiler", False)):
+            self.profiler = LoopProfiler(
+                consul.metrics, float(config.get("slow-step", 20)) / 1000, int(config.get("slowlog-size", 128))
+            )
+
+    def gauges(self) -> dict[str, float]:
+        cache = self.consul.db.cache
+        lookups = cache.hits + cache.misses
+        res = {
+            "uptime_seconds": int(time.monotonic() - self.started),
+            "trio_tasks_living": trio.lowlevel.current_statistics().tasks_living,
+            "sessions": len(self.consul.sessions),
+            "gatehouse_refused": self.consul.gh.admission.refused,
+            "heartbeat_timeouts": self.consul.heartbeats.timeouts,
+            "heartbeat_acks": self.consul.heartbeats.acks,
+            "heartbeat_suppressed": self.consul.heartbeats.suppressed,
+            "redis_cache_hits": cache.hits,
+            "redis_cache_misses": cache.misses,
+            "redis_cache_evictions": cache.evictions,
+            "redis_cache_invalidations": cache.invalidations,
+            "redis_cache_hit_rate": cache.hits / lookups if lookups else 0.0,
+        }
+        for key, value in self.consul.db.in_queue.statistics().items():
+            res[f"redis_queue_{key}"] = value
+        for key, value in self.consul.gh.statistics().items():
+            res[f"gatehouse_{key}"] = value
+        res.update(self.rates)
+        return res
+
+    def snapshot(self) -> dict[str, float]:
+        # Histogram summaries cost a scan per histogram, INFO reuses them for up to one export interval.
+        now = time.monotonic()
+        if self.summarised is None or now - self.summarised >= self.export_interval:
+            self.summaries = self.consul.metrics.summaries()
+            self.summarised = now
+        res = self.gauges()
+        res.update(self.consul.metrics.counters)
+        res.update(self.summaries)
+        return res
+
+    async def info(self, proto, section=None) -> bytes:
+        return resp_bulk(render_info(self.snapshot(), section))
+
+    def slowlog(self, count: int = -1) -> list[SlowStep]:
+        if self.profiler is None:
+            return []
+        entries = list(self.profiler.slowlog)
+        return entries if count < 0 else entries[:count]
+
+    async def slowlog_get(self, proto, count=10) -> bytes:
+        return resp_encode([
+            [entry.id, entry.timestamp, entry.duration_us, entry.task, entry.stack] for entry in self.slowlog(count)
+        ])
+
+    async def slowlog_len(self, proto) -> bytes:
+        return resp_encode(len(self.slowlog()))
+
+    async def slowlog_reset(self, proto) -> bytes:
+        if self.profiler is not None:
+            self.profiler.reset()
+        return b"+OK\r\n"
+
+    def update_rates(self, elapsed: float):
+        for name, hist in self.consul.metrics.histograms.items():
+            if name.startswith("command_"):
+                self.rates[f"{name}_per_sec"] = (hist.count - self.counts.get(name, 0)) / elapsed
+                self.counts[name] = hist.count
 
     async def watchman(self):
+        if self.profiler is not None:
+            self.profiler.start()
+        metrics = self.consul.metrics
+        deadline = last_export = trio.current_time()
         while True:
-            await trio.sleep(2)
-            sentry_sdk.metrics.gauge(
-                key="trio_tasks_living",
-                value=trio.lowlevel.current_statistics().tasks_living
-            )
+            deadline += self.lag_interval
+            await trio.sleep_until(deadline)
+            now = trio.current_time()
+            metrics.record("loop_lag", int((now - deadline) * 1e9))
+            deadline = max(deadline, now - self.lag_interval)
+            if now - last_export < self.export_interval:
+                continue
+            self.update_rates(now - last_export)
+            last_export = now
+            snapshot = self.snapshot()
+            for key, value in snapshot.items():
+                sentry_sdk.metrics.gauge(key=key, value=value)
+            if self.consul.reports is not None:
+                self.consul.reports.put_nowait((self.consul.worker_id, snapshot))
 
 
 class Consular:
@@ -13,3 +13,29 @@ class Execution(Exception):
 class DeadSignalError(Exception):
     def __str__(self):
         return "Dead signal received."
+
+
+class AbortedReadError(Exception):
+    def __init__(self, command=None):
+        self.command = command
+
+    def __str__(self):
+        return f"Coalesced read{f' {self.command}' if self.command else ''} aborted before completion."
+
+
+class ArgumentError(Exception):
+    def __init__(self, reason=None):
+        self.reason = reason
+
+    def __str__(self):
+        return f"Invalid arguments.{f' {self.reason}' if self.reason else ''}"
+
+
+class OverloadError(Exception):
+    def __str__(self):
+        return "Server is overloaded."
+
+
+class QueueFullError(OverloadError):
+    def __str__(self):
+        return "Queue is full."
@@ -0,0 +1,122 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import json
+import re
+import typing
+
+import sentry_sdk
+import trio
+
+from src.metrics import Histogram
+
+INFO_SECTIONS = (
+    ("gatehouse", "gatehouse_"),
+    ("redis", "redis_"),
+    ("heartbeat", "heartbeat_"),
+    ("commands", "command_"),
+    ("stages", "stage_"),
+)
+
+
+def _info_section(key: str) -> str:
+    for name, prefix in INFO_SECTIONS:
+        if key.startswith(prefix):
+            return name
+    return "server"
+
+
+def _format(value) -> str:
+    if isinstance(value, float):
+        return f"{value:.3f}"
+    return str(value)
+
+
+def render_info(snapshot: dict[str, float], section: typing.Optional[str] = None) -> str:
+    groups: dict[str, list[str]] = {"server": [], **{name: [] for name, _ in INFO_SECTIONS}}
+    for key, value in sorted(snapshot.items()):
+        groups[_info_section(key)].append(f"{key}:{_format(value)}")
+    if section is not None:
+        section = section.lower()
+        groups = {name: lines for name, lines in groups.items() if name == section}
+    groups = {name: lines for name, lines in groups.items() if lines}
+    return "".join(f"# {name.capitalize()}\r\n" + "\r\n".join(lines) + "\r\n\r\n" for name, lines in groups.items())
+
+
+def _metric_name(key: str) -> str:
+    return "clousocket_" + re.sub(r"[^a-zA-Z0-9_]", "_", key)
+
+
+def _labels(base: str, **extra) -> str:
+    labels = [base] if base else []
+    labels += [f'{key}="{value}"' for key, value in extra.items()]
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def render_prometheus(
+    gauges: dict[str, float], counters: dict[str, int], histograms: dict[str, Histogram], worker_id=None
+) -> str:
+    base = f'worker="{worker_id}"' if worker_id is not None else ""
+    lines = []
+    for key, value in sorted(gauges.items()):
+        name = _metric_name(key)
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name}{_labels(base)} {value}")
+    for key, value in sorted(counters.items()):
+        name = _metric_name(key) + "_total"
+        lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name}{_labels(base)} {value}")
+    for key, hist in sorted(histograms.items()):
+        name = _metric_name(key) + "_seconds"
+        lines.append(f"# TYPE {name} summary")
+        for quantile, value in zip((0.5, 0.99, 0.999), hist.percentiles((50, 99, 99.9))):
+            lines.append(f"{name}{_labels(base, quantile=quantile)} {value / 1e9}")
+        lines.append(f"{name}_sum{_labels(base)} {hist.total / 1e9}")
+        lines.append(f"{name}_count{_labels(base)} {hist.count}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsEndpoint:
+    def __init__(self, consul, host: str, port: int):
+        self.consul = consul
+        self.host = host
+        self.port = port
+
+    async def serve(self):
+        await trio.serve_tcp(self.handle, self.port, host=self.host)
+
+    def render(self) -> str:
+        metrics = self.consul.metrics
+        return render_prometheus(
+            self.consul.wt.gauges(), metrics.counters, metrics.histograms, self.consul.worker_id
+        )
+
+    async def handle(self, stream: trio.SocketStream):
+        async with stream:
+            try:
+                data = b""
+                with trio.move_on_after(5):
+                    while b"\r\n\r\n" not in data and len(data) < 8192:
+                        chunk = await stream.receive_some(4096)
+                        if not chunk:
+                            return
+                        data += chunk
+                request = data.split(b"\r\n", 1)[0].split()
+                path = request[1].split(b"?")[0] if len(request) >= 2 and request[0] == b"GET" else None
+                if path == b"/metrics":
+                    status, content_type, body = "200 OK", "text/plain; version=0.0.4", self.render()
+                elif path == b"/slowlog":
+                    body = json.dumps([entry.as_dict() for entry in self.consul.wt.slowlog()])
+                    status, content_type = "200 OK", "application/json"
+                else:
+                    status, content_type, body = "404 Not Found", "text/plain", "not found\n"
+                payload = body.encode()
+                await stream.send_all(
+                    f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload
+                )
+            except (trio.BrokenResourceError, trio.ClosedResourceError):
+                pass
+            except Exception as err:
+                sentry_sdk.capture_exception(err)
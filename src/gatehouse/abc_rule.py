@@ -3,14 +3,25 @@
 #
 
 import abc
+import typing
 
 import trio
 
 
 class ABCRule(abc.ABC):
     name: str
+    watches_commands: bool = False
+    cacheable: bool = True
+    cost: float = 1.0
+    selectivity: float = 0.0
+    depends: tuple[str, ...] = ()
+    timeout: typing.Optional[float] = None
+    fail_open: bool = False
 
     def __init__(self, consul):
         self.consul = consul
 
     async def handle(self, proto: trio.SocketStream, addr) -> bool: ...
+
+    async def on_command(self, session, request) -> bool:
+        return True
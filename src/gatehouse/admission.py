@@ -0,0 +1,50 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import math
+import typing
+
+import trio
+
+
+class Queued(typing.Protocol):
+    sojourn: float
+
+
+class AdmissionController:
+    def __init__(self, config: dict, *queues: Queued):
+        self.queues = queues
+        self.target = float(config.get("latency-target", 5)) / 1000
+        self.interval = float(config.get("latency-interval", 100)) / 1000
+        self.first_above = 0.0
+        self.dropping = False
+        self.drop_next = 0.0
+        self.count = 0
+        self.refused = 0
+
+    def sojourn(self) -> float:
+        return max((queue.sojourn for queue in self.queues), default=0.0)
+
+    def admit(self) -> bool:
+        now = trio.current_time()
+        if self.sojourn() < self.target:
+            self.first_above = 0.0
+            self.dropping = False
+            return True
+        if not self.first_above:
+            self.first_above = now + self.interval
+            return True
+        if not self.dropping:
+            if now < self.first_above:
+                return True
+            self.dropping = True
+            recently = now - self.drop_next < 16 * self.interval
+            self.count = max(1, self.count - 2) if recently else 1
+            self.drop_next = now
+        if now < self.drop_next:
+            return True
+        self.count += 1
+        self.drop_next = now + self.interval / math.sqrt(self.count)
+        self.refused += 1
+        return False
@@ -7,13 +7,16 @@ import importlib
 import importlib.util
 import sys
 import time
-import uuid
+import typing
 
+import cachebox
 import sentry_sdk
 import trio
 
+from src.errors import OverloadError
 from src.gatehouse.abc_rule import ABCRule
-from src.utils import IOQueue
+from src.gatehouse.admission import AdmissionController
+from src.metrics import Histogram
 
 
 def _load_from_module_spec(spec: importlib.machinery.ModuleSpec, key: str):
@@ -39,13 +42,56 @@ def load_names(name: str):
     return _load_from_module_spec(spec, name)
 
 
+class RuleStage:
+    def __init__(self, inline: list[ABCRule], concurrent: list[ABCRule]):
+        self.inline = inline
+        self.concurrent = concurrent
+
+
+def plan_rules(rules: list[ABCRule], inline_cost: float) -> list[RuleStage]:
+    names = {rule.name for rule in rules}
+    ordered = sorted(rules, key=lambda rule: (rule.cost / max(rule.selectivity, 1e-3), rule.cost))
+    done: set[str] = set()
+    stages = []
+    while ordered:
+        ready = [rule for rule in ordered if all(dep in done or dep not in names for dep in rule.depends)]
+        if not ready:
+            raise Exception(f"Circular rule dependencies: {', '.join(rule.name for rule in ordered)}")
+        stages.append(RuleStage(
+            [rule for rule in ready if rule.cost <= inline_cost],
+            [rule for rule in ready if rule.cost > inline_cost]
+        ))
+        done.update(rule.name for rule in ready)
+        ordered = [rule for rule in ordered if rule.name not in done]
+    return stages
+
+
 class Gatehouse:
     def __init__(self, consul):
         self.consul = consul
-        self.thread_count = consul.config["gatehouse"]["thread-count"]
-        self.in_queue = IOQueue()
-        self.out_queue = IOQueue()
+        config = consul.config["gatehouse"]
+        self.inline_cost = float(config.get("inline-cost", 1))
+        self.verdict_ttl = float(config.get("verdict-ttl", 30))
+        self.verdicts: typing.Optional[cachebox.TTLCache] = None
+        if self.verdict_ttl > 0:
+            self.verdicts = cachebox.TTLCache(int(config.get("verdict-cache-size", 65536)), self.verdict_ttl)
+        self.verdict_hits = 0
+        self.verdict_misses = 0
+        self.depth = 0
+        self.max_checks = int(config.get("max-checks", 1024))
+        self.waiters = trio.lowlevel.ParkingLot()
+        self.waiting: dict[object, int] = {}
+        self.admission = AdmissionController(config, self, consul.db.in_queue)
+        self.version = 0
         self.rules: list[ABCRule] = []
+        self.cached_plan: list[RuleStage] = []
+        self.live_plan: list[RuleStage] = []
+        self.command_rules: list[ABCRule] = []
+        self.latencies: dict[str, Histogram] = {}
+        self.load_rules(self.discover_rules())
+
+    def discover_rules(self) -> list[ABCRule]:
+        rules = []
         names = glob.glob('./gatehouse/rules/*')
         for nn in names:
             if nn.endswith("__pycache__"):
@@ -54,44 +100,133 @@ class Gatehouse:
             name = name[0:len(name) - 3]
             rule_m = load_names(f"gatehouse.rules.{name}")
             rule = getattr(rule_m, "export_rule")(self.consul)
-            self.rules.append(rule)
-
-    async def execute(self, proto: trio.SocketStream, addr):
-        with sentry_sdk.start_transaction(op="subprocess.communicate", name="Gatehouse Handling"):
-            pid = uuid.uuid1()
-            await self.in_queue.append((proto, addr), pid)
-            async for data, cid in self.out_queue:
-                if cid == pid:
-                    return data
-
-    async def starter(self):
-        for _ in range(self.thread_count):
-            trio.lowlevel.spawn_system_task(self.gate)
-
-    async def gate(self):
-        async for comm, cid in self.in_queue:
-            proto: trio.SocketStream = comm[0]
-            addr = comm[1]
-            ts = time.perf_counter_ns()
-            checks = dict()
-            with sentry_sdk.start_transaction(op="middleware.handle", name="Gatehouse Gate Check"):
-                try:
-                    for rule in self.rules:
-                        rule_res = await rule.handle(proto, addr)
-                        if not rule_res:
-                            res = False
-                            break
-                        res = True
-                        checks[rule.name] = res
-                    await self.out_queue.append(res, cid)
-                    te = (time.perf_counter_ns() - ts) / 1000000
-                    sentry_sdk.set_measurement('redis_command_exec', te, 'miliseconds')
-                    sentry_sdk.metrics.distribution(
-                        key="gatehouse_handling_duration",
-                        value=te,
-                        unit="millisecond"
-                    )
-                    sentry_sdk.set_context("Gate Rules Responses", checks)
-                except Exception as err:
-                    sentry_sdk.capture_exception(err)
-                    continue
+            rules.append(rule)
+        return rules
+
+    def load_rules(self, rules: list[ABCRule]):
+        self.rules = rules
+        self.cached_plan = plan_rules([rule for rule in rules if rule.cacheable], self.inline_cost)
+        self.live_plan = plan_rules([rule for rule in rules if not rule.cacheable], self.inline_cost)
+        self.latencies = {
+            rule.name: self.consul.metrics.histogram(f"gatehouse_rule_{rule.name.lower().replace(' ', '_')}")
+            for rule in rules
+        }
+        self.command_rules = [rule for rule in rules if rule.watches_commands]
+        self.version += 1
+        if self.verdicts is not None:
+            self.verdicts.clear()
+
+    async def evaluate(self, rule: ABCRule, proto: trio.SocketStream, addr, checks: dict) -> bool:
+        ts = time.perf_counter_ns()
+        res = rule.fail_open
+        try:
+            if rule.timeout is None:
+                res = bool(await rule.handle(proto, addr))
+            else:
+                with trio.move_on_after(rule.timeout) as scope:
+                    res = bool(await rule.handle(proto, addr))
+                if scope.cancelled_caught:
+                    checks[f"{rule.name} timeout"] = True
+        except Exception as err:
+            sentry_sdk.capture_exception(err)
+        self.latencies[rule.name].record(time.perf_counter_ns() - ts)
+        checks[rule.name] = res
+        return res
+
+    async def run_rules(self, plan: list[RuleStage], proto: trio.SocketStream, addr, checks: dict) -> bool:
+        for stage in plan:
+            for rule in stage.inline:
+                if not await self.evaluate(rule, proto, addr, checks):
+                    return False
+            if len(stage.concurrent) == 1:
+                if not await self.evaluate(stage.concurrent[0], proto, addr, checks):
+                    return False
+            elif stage.concurrent:
+                refused = False
+
+                async def check(rule: ABCRule, cancel_scope: trio.CancelScope):
+                    nonlocal refused
+                    if not await self.evaluate(rule, proto, addr, checks):
+                        refused = True
+                        cancel_scope.cancel()
+
+                async with trio.open_nursery() as nursery:
+                    for rule in stage.concurrent:
+                        nursery.start_soon(check, rule, nursery.cancel_scope)
+                if refused:
+                    return False
+        return True
+
+    async def check_command(self, session, request) -> bool:
+        for rule in self.command_rules:
+            res = rule.fail_open
+            try:
+                if rule.timeout is None:
+                    res = bool(await rule.on_command(session, request))
+                else:
+                    with trio.move_on_after(rule.timeout):
+                        res = bool(await rule.on_command(session, request))
+            except Exception as err:
+                sentry_sdk.capture_exception(err)
+            if not res:
+                return False
+        return True
+
+    @property
+    def sojourn(self) -> float:
+        for started in self.waiting.values():
+            return (time.perf_counter_ns() - started) / 1e9
+        return 0.0
+
+    async def wait_for_slot(self):
+        token = object()
+        self.waiting[token] = time.perf_counter_ns()
+        try:
+            await self.waiters.park()
+        finally:
+            del self.waiting[token]
+
+    def release(self):
+        if not self.waiters.unpark():
+            self.depth -= 1
+
+    async def execute(self, proto: trio.SocketStream, addr) -> bool:
+        if not self.admission.admit():
+            raise OverloadError()
+        if self.depth < self.max_checks and not self.waiting:
+            self.depth += 1
+        else:
+            await self.wait_for_slot()
+        ts = time.perf_counter_ns()
+        checks = dict()
+        with self.consul.metrics.trace("middleware.handle", "Gatehouse Gate Check") as trs:
+            try:
+                key = (addr[0], self.version)
+                res = self.verdicts.get(key, None) if self.verdicts is not None else None
+                if res is None:
+                    self.verdict_misses += 1
+                    res = await self.run_rules(self.cached_plan, proto, addr, checks)
+                    if self.verdicts is not None:
+                        self.verdicts.insert(key, res)
+                else:
+                    self.verdict_hits += 1
+                if res:
+                    res = await self.run_rules(self.live_plan, proto, addr, checks)
+            except Exception as err:
+                sentry_sdk.capture_exception(err)
+                res = False
+            finally:
+                self.release()
+            te = time.perf_counter_ns() - ts
+            self.consul.metrics.record("stage_gatehouse", te)
+            trs.set_data("Gate Rules Responses", checks)
+        return res
+
+    def statistics(self) -> dict[str, float]:
+        return {
+            "in_flight"     : self.depth,
+            "waiting"       : len(self.waiting),
+            "verdict_hits"  : self.verdict_hits,
+            "verdict_misses": self.verdict_misses,
+            "sojourn_ms"    : self.sojourn * 1000,
+        }
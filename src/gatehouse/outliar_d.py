@@ -1,3 +1,9 @@
+import argparse
+import copy
+import random
+import typing
+
+import joblib
 import numpy as np
 from sklearn.kernel_approximation import Nystroem
 from sklearn.linear_model import SGDClassifier
@@ -19,6 +25,7 @@ class ReqClassifier:
         self.prep_data()
         self.x = np.array(self.x)
         self.test_x = np.array(self.test_x)
+        self.test_features = self.test_x.copy()
         self.x_without_outlier = np.array(self.x_without_outlier)
 
         self.kd = KernelDensity(kernel='epanechnikov', bandwidth="silverman", algorithm="ball_tree")
@@ -115,10 +122,95 @@ class ReqClassifier:
         x = x * self.kd.score(x)
         return self.cl.predict(x)[0]
 
+    def export(self, path):
+        cl = self.cl.best_estimator_ if hasattr(self.cl, "best_estimator_") else self.cl
+        joblib.dump({"pp": self.pp, "kd": self.kd, "cl": cl}, path)
+
+
+class ReqModel:
+    def __init__(self, pp, kd, cl):
+        self.pp = pp
+        self.kd = kd
+        self.cl = cl
+        self.grid = np.zeros((0, 0), dtype=bool)
+        # The epanechnikov kernel has bounded support, far-off inputs score -inf. Weight them like the sparsest
+        # training sample instead, the pipeline rejects infinite features.
+        self.floor = float(kd.score_samples(np.asarray(kd.tree_.get_arrays()[0])).min())
+
+    @classmethod
+    def load(cls, path):
+        return cls(**joblib.load(path))
+
+    def save(self, path):
+        joblib.dump({"pp": self.pp, "kd": self.kd, "cl": self.cl}, path)
+
+    def _features(self, features: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        x = self.pp.transform(features)
+        density = self.kd.score_samples(x)
+        return x * np.maximum(density, self.floor).reshape(-1, 1), np.isfinite(density)
+
+    def predict_exact(self, features: np.ndarray) -> np.ndarray:
+        x, supported = self._features(features)
+        # Nothing like these was ever seen in training, which is what an outlier is.
+        return np.where(supported, self.cl.predict(x), 1)
+
+    def build_grid(self, risks: int, counts: int):
+        risk, count = np.meshgrid(np.arange(risks), np.arange(counts), indexing="ij")
+        features = np.column_stack((risk.ravel(), count.ravel()))
+        self.grid = self.predict_exact(features).astype(bool).reshape(risks, counts)
+
+    def lookup(self, risk: int, command_cn: int) -> typing.Optional[bool]:
+        if 0 <= risk < self.grid.shape[0] and 0 <= command_cn < self.grid.shape[1]:
+            return bool(self.grid[risk, command_cn])
+        return None
+
+    def predict(self, features: np.ndarray) -> np.ndarray:
+        features = np.asarray(features)
+        ints = features.astype(np.int64)
+        inside = (features == ints).all(axis=1) & (ints >= 0).all(axis=1) & \
+            (ints[:, 0] < self.grid.shape[0]) & (ints[:, 1] < self.grid.shape[1])
+        res = np.zeros(len(features), dtype=bool)
+        res[inside] = self.grid[ints[inside, 0], ints[inside, 1]]
+        if not inside.all():
+            res[~inside] = self.predict_exact(features[~inside]).astype(bool)
+        return res
+
+    def updated(self, samples: list[tuple[int, int, int]]) -> "ReqModel":
+        data = np.array(samples, dtype=np.float64)
+        cl = copy.deepcopy(self.cl)
+        cl.partial_fit(self._features(data[:, :2])[0], data[:, 2].astype(int), classes=np.array([0, 1]))
+        model = ReqModel(self.pp, self.kd, cl)
+        model.build_grid(*self.grid.shape)
+        return model
+
+
+class Reservoir:
+    def __init__(self, size: int):
+        self.size = size
+        self.items = []
+        self.seen = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item):
+        self.seen += 1
+        if len(self.items) < self.size:
+            self.items.append(item)
+            return
+        idx = random.randrange(self.seen)
+        if idx < self.size:
+            self.items[idx] = item
+
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Train the request outlier detector.")
+    parser.add_argument("--output", default="./gatehouse/req_model.joblib")
+    args = parser.parse_args()
+
     a = ReqClassifier()
     a.fit()
+    a.export(args.output)
     res = a.cl.score(a.test_x, a.test_y)
     print(res)
     y_pred_rf = a.cl.predict(a.test_x)
@@ -131,3 +223,9 @@ if __name__ == '__main__':
                 continue
             else:
                 print(i)
+
+    model = ReqModel.load(args.output)
+    model.build_grid(11, 11)
+    original = np.array([a.predict(risk, command_cn) for risk, command_cn in a.test_features]).astype(bool)
+    grid = model.predict(a.test_features)
+    print(f"grid agrees with the trained pipeline on {int((grid == original).sum())}/{len(original)} test samples")
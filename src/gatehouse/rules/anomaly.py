@@ -0,0 +1,140 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import time
+
+import numpy as np
+import sentry_sdk
+import trio
+
+from src.consul import SupremeConsul
+from src.gatehouse.abc_rule import ABCRule
+from src.gatehouse.outliar_d import ReqModel, Reservoir
+from src.utils import ReplySlot
+
+
+class Rule(ABCRule):
+    name = "Request Anomaly Detector"
+
+    def __init__(self, consul: SupremeConsul):
+        super().__init__(consul)
+        config = consul.config["gatehouse"].get("anomaly", {})
+        self.enabled = bool(config.get("enabled", False))
+        self.block = config.get("action", "log") == "block"
+        self.window = float(config.get("window", 1000)) / 1000
+        self.batch_window = float(config.get("batch-window", 2)) / 1000
+        self.max_count = int(config.get("max-command-count", 10))
+        self.max_risk = int(config.get("max-risk", 10))
+        self.learning = self.enabled and bool(config.get("learning", False))
+        self.retrain_interval = float(config.get("retrain-interval", 60))
+        self.min_samples = int(config.get("min-samples", 100))
+        self.label_key = config.get("label-key", "clousocket:anomaly:labels")
+        self.checkpoint = config.get("checkpoint", "")
+        self.reservoir = Reservoir(int(config.get("reservoir-size", 10000)))
+        self.model = None
+        if self.enabled:
+            self.model = ReqModel.load(config.get("model", "./gatehouse/req_model.joblib"))
+            self.model.build_grid(self.max_risk + 1, self.max_count + 1)
+        self.watches_commands = self.enabled
+        self.pending: dict[tuple[int, int], ReplySlot] = {}
+        self.scored = 0
+        self.batches = 0
+        self.outliers = 0
+        self.labels = 0
+        self.bad_labels = 0
+        self.trained_labels = 0
+        self.generation = 0
+        if self.learning:
+            trio.lowlevel.spawn_system_task(self.learner)
+
+    async def handle(self, proto: trio.SocketStream, addr):
+        return True
+
+    def features(self, session, request) -> tuple[int, int]:
+        now = time.monotonic()
+        state = session.rule_state.get(self)
+        if state is None or now - state[0] >= self.window:
+            state = session.rule_state[self] = [now, 0]
+        state[1] += 1
+        return request.spec.risk, min(state[1], self.max_count)
+
+    def enqueue(self, features: tuple[int, int]) -> ReplySlot:
+        slot = self.pending.get(features)
+        if slot is None:
+            slot = self.pending[features] = ReplySlot()
+            if len(self.pending) == 1:
+                trio.lowlevel.spawn_system_task(self.flush)
+        return slot
+
+    async def flush(self):
+        await trio.sleep(self.batch_window)
+        batch, self.pending = self.pending, {}
+        model = self.model
+        try:
+            res = await trio.to_thread.run_sync(
+                model.predict, np.array(list(batch), dtype=np.float64), limiter=self.consul.limiter
+            )
+        except Exception as err:
+            sentry_sdk.capture_exception(err)
+            for slot in batch.values():
+                slot.resolve(False)
+            return
+        self.batches += 1
+        self.scored += len(batch)
+        for (features, slot), outlier in zip(batch.items(), res):
+            self.outliers += bool(outlier)
+            slot.resolve(bool(outlier))
+
+    async def poll_labels(self):
+        while True:
+            entries = await self.consul.db.execute("LPOP", self.label_key, 100)
+            if not entries:
+                return
+            for entry in entries:
+                try:
+                    risk, command_cn, label = (int(part) for part in entry.split())
+                    if risk < 0 or command_cn < 0:
+                        raise ValueError(entry)
+                except (AttributeError, ValueError):
+                    self.bad_labels += 1
+                    sentry_sdk.capture_message(f"Skipping malformed anomaly label {entry!r}", level="warning")
+                    continue
+                self.labels += 1
+                self.reservoir.add((risk, min(command_cn, self.max_count), int(label > 0)))
+
+    async def learner(self):
+        while True:
+            await trio.sleep(self.retrain_interval)
+            try:
+                await self.poll_labels()
+                if len(self.reservoir) < self.min_samples or self.labels == self.trained_labels:
+                    continue
+                labels = self.labels
+                samples = list(self.reservoir.items)
+                model = await trio.to_thread.run_sync(self.model.updated, samples, limiter=self.consul.limiter)
+                if self.checkpoint:
+                    await trio.to_thread.run_sync(model.save, self.checkpoint, limiter=self.consul.limiter)
+            except Exception as err:
+                sentry_sdk.capture_exception(err)
+                continue
+            self.model = model
+            self.trained_labels = labels
+            self.generation += 1
+
+    async def on_command(self, session, request) -> bool:
+        features = self.features(session, request)
+        outlier = self.model.lookup(*features)
+        if outlier is None:
+            slot = self.enqueue(features)
+            if not self.block:
+                return True
+            outlier = await slot.wait()
+        else:
+            self.scored += 1
+            self.outliers += outlier
+        return not (self.block and outlier)
+
+
+def export_rule(consul):
+    return Rule(consul)
@@ -0,0 +1,188 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import array
+import collections
+import hashlib
+import ipaddress
+import time
+
+import sentry_sdk
+import trio
+from redio.exc import ServerError
+
+from src.consul import SupremeConsul
+from src.gatehouse.abc_rule import ABCRule
+
+TOKEN_BUCKET_LUA = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local cost = tonumber(ARGV[1])
+local allowed = 1
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local rate, burst = tonumber(ARGV[i * 2]), tonumber(ARGV[i * 2 + 1])
+    local state = redis.call('HMGET', key, 't', 's')
+    local t = tonumber(state[1]) or burst
+    local s = tonumber(state[2]) or now
+    t = math.min(burst, t + math.max(0, now - s) * rate)
+    if t < cost then allowed = 0 end
+    tokens[i] = t
+end
+for i, key in ipairs(KEYS) do
+    local rate, burst = tonumber(ARGV[i * 2]), tonumber(ARGV[i * 2 + 1])
+    local t = tokens[i]
+    if allowed == 1 then t = t - cost end
+    redis.call('HSET', key, 't', t, 's', now)
+    redis.call('PEXPIRE', key, math.ceil(burst / rate * 1000) + 1000)
+end
+return allowed
+"""
+TOKEN_BUCKET_SHA = hashlib.sha1(TOKEN_BUCKET_LUA.encode()).hexdigest()
+
+
+class BucketTable:
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.index: collections.OrderedDict[str, int] = collections.OrderedDict()
+        self.generation = array.array("L", [0]) * slots
+        self.conn_tokens = array.array("d", [0.0]) * slots
+        self.conn_stamp = array.array("d", [0.0]) * slots
+        self.cmd_tokens = array.array("d", [0.0]) * slots
+        self.cmd_stamp = array.array("d", [0.0]) * slots
+
+    def slot(self, key: str, now: float, conn_burst: float, cmd_burst: float) -> int:
+        idx = self.index.get(key)
+        if idx is not None:
+            self.index.move_to_end(key)
+            return idx
+        if len(self.index) < self.slots:
+            idx = len(self.index)
+        else:
+            _, idx = self.index.popitem(last=False)
+            self.generation[idx] += 1
+        self.index[key] = idx
+        self.conn_tokens[idx] = conn_burst
+        self.conn_stamp[idx] = now
+        self.cmd_tokens[idx] = cmd_burst
+        self.cmd_stamp[idx] = now
+        return idx
+
+    @staticmethod
+    def take(tokens: array.array, stamp: array.array, idx: int, rate: float, burst: float, now: float) -> bool:
+        level = tokens[idx] + (now - stamp[idx]) * rate
+        if level > burst:
+            level = burst
+        stamp[idx] = now
+        if level < 1:
+            tokens[idx] = level
+            return False
+        tokens[idx] = level - 1
+        return True
+
+
+class Rule(ABCRule):
+    name = "Token Bucket Rate Limit"
+    cacheable = False
+
+    def __init__(self, consul: SupremeConsul):
+        super().__init__(consul)
+        config = consul.config["gatehouse"].get("rate-limit", {})
+        self.enabled = bool(config.get("enabled", False))
+        self.watches_commands = self.enabled
+        self.shared = config.get("mode", "local") == "redis"
+        self.selectivity = 0.01
+        self.fail_open = True
+        if self.shared:
+            self.cost = 10.0
+            self.timeout = float(config.get("timeout", 50)) / 1000
+        self.ipv4_prefix = int(config.get("ipv4-prefix", 24))
+        self.ipv6_prefix = int(config.get("ipv6-prefix", 64))
+        self.conn_rate = float(config.get("connection-rate", 10))
+        self.conn_burst = float(config.get("connection-burst", 20))
+        self.net_conn_rate = float(config.get("subnet-connection-rate", 100))
+        self.net_conn_burst = float(config.get("subnet-connection-burst", 200))
+        self.cmd_rate = float(config.get("command-rate", 1000))
+        self.cmd_burst = float(config.get("command-burst", 2000))
+        self.net_cmd_rate = float(config.get("subnet-command-rate", 10000))
+        self.net_cmd_burst = float(config.get("subnet-command-burst", 20000))
+        slots = int(config.get("slots", 65536))
+        self.ips = BucketTable(slots)
+        self.nets = BucketTable(slots)
+        self.limited = 0
+
+    def keys(self, host: str) -> tuple[str, str]:
+        ip = ipaddress.ip_address(host)
+        prefix = self.ipv4_prefix if ip.version == 4 else self.ipv6_prefix
+        return str(ip), str(ipaddress.ip_network(f"{ip}/{prefix}", strict=False))
+
+    async def shared_take(self, ip_key: str, net_key: str, command: bool) -> bool:
+        rates = (self.cmd_rate, self.cmd_burst, self.net_cmd_rate, self.net_cmd_burst) if command else \
+            (self.conn_rate, self.conn_burst, self.net_conn_rate, self.net_conn_burst)
+        kind = "cmd" if command else "conn"
+        keys = (f"clousocket:rl:{{{net_key}}}:{kind}:{ip_key}", f"clousocket:rl:{{{net_key}}}:{kind}")
+        try:
+            try:
+                res = await self.consul.db.execute("EVALSHA", TOKEN_BUCKET_SHA, 2, *keys, 1, *rates)
+            except ServerError as err:
+                res = err
+            if isinstance(res, ServerError) and str(res).startswith("NOSCRIPT"):
+                res = await self.consul.db.execute("EVAL", TOKEN_BUCKET_LUA, 2, *keys, 1, *rates)
+            if isinstance(res, ServerError):
+                raise res
+            return bool(int(res))
+        except Exception as err:
+            sentry_sdk.capture_exception(err)
+            return True
+
+    def local_slots(self, ip_key: str, net_key: str, now: float) -> tuple[int, int, int, int]:
+        ip_idx = self.ips.slot(ip_key, now, self.conn_burst, self.cmd_burst)
+        net_idx = self.nets.slot(net_key, now, self.net_conn_burst, self.net_cmd_burst)
+        return ip_idx, self.ips.generation[ip_idx], net_idx, self.nets.generation[net_idx]
+
+    async def handle(self, proto: trio.SocketStream, addr):
+        if not self.enabled:
+            return True
+        ip_key, net_key = self.keys(addr[0])
+        if self.shared:
+            allowed = await self.shared_take(ip_key, net_key, False)
+        else:
+            now = time.monotonic()
+            ip_idx, _, net_idx, _ = self.local_slots(ip_key, net_key, now)
+            allowed = BucketTable.take(
+                self.ips.conn_tokens, self.ips.conn_stamp, ip_idx, self.conn_rate, self.conn_burst, now
+            ) and BucketTable.take(
+                self.nets.conn_tokens, self.nets.conn_stamp, net_idx, self.net_conn_rate, self.net_conn_burst, now
+            )
+        if not allowed:
+            self.limited += 1
+        return allowed
+
+    async def on_command(self, session, request) -> bool:
+        state = session.rule_state.get(self)
+        if state is None:
+            state = session.rule_state[self] = [*self.keys(session.proto.socket.getpeername()[0]), -1, -1, -1, -1]
+        if self.shared:
+            allowed = await self.shared_take(state[0], state[1], True)
+        else:
+            now = time.monotonic()
+            ip_idx, ip_gen, net_idx, net_gen = state[2], state[3], state[4], state[5]
+            if ip_idx < 0 or self.ips.generation[ip_idx] != ip_gen or self.nets.generation[net_idx] != net_gen:
+                state[2:] = self.local_slots(state[0], state[1], now)
+                ip_idx, net_idx = state[2], state[4]
+            else:
+                self.ips.index.move_to_end(state[0])
+                self.nets.index.move_to_end(state[1])
+            allowed = BucketTable.take(
+                self.ips.cmd_tokens, self.ips.cmd_stamp, ip_idx, self.cmd_rate, self.cmd_burst, now
+            ) and BucketTable.take(
+                self.nets.cmd_tokens, self.nets.cmd_stamp, net_idx, self.net_cmd_rate, self.net_cmd_burst, now
+            )
+        if not allowed:
+            self.limited += 1
+        return allowed
+
+
+def export_rule(consul):
+    return Rule(consul)
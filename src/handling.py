@@ -4,7 +4,8 @@
 
 import typing
 
-from src.middleware.serialisation import Command, Data, End, SubCommand
+from src.middleware.serialisation import Request
+from src.red_db import coalesce_reads
 
 
 class Handler:
@@ -15,18 +16,12 @@ class Handler:
     def add_command(self, name: str, op: typing.Awaitable):
         self.ops[name] = op
 
-    async def handle(self, proto, data: Command):
-        raw_data = data
-        if isinstance(data.next, SubCommand):
-            op: typing.Awaitable = self.ops[f"{raw_data.this}_{raw_data.next.this}"]
-            raw_data = raw_data.next
-        else:
-            op: typing.Awaitable = self.ops[raw_data.this]
-        args = []
-        while True:
-            if raw_data.next == End():
-                break
-            elif isinstance(raw_data.next, Data):
-                args.append(raw_data.next.this)
-                raw_data = raw_data.next
-        await op(proto, *args)
+    async def handle(self, proto, data: Request):
+        op: typing.Awaitable = self.ops[data.spec.key]
+        if not data.spec.coalesce:
+            return await op(proto, *data.args)
+        token = coalesce_reads.set(True)
+        try:
+            return await op(proto, *data.args)
+        finally:
+            coalesce_reads.reset(token)
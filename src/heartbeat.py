@@ -0,0 +1,112 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import math
+import typing
+
+import hiredis
+import trio
+
+
+class TimerWheel:
+    def __init__(self, resolution: float, size: int):
+        self.resolution = resolution
+        self.size = size
+        self.tick = 0
+        self.slots: list[dict[typing.Hashable, int]] = [{} for _ in range(size)]
+        self.where: dict[typing.Hashable, int] = {}
+
+    def __len__(self):
+        return len(self.where)
+
+    def schedule(self, key: typing.Hashable, delay: float):
+        self.cancel(key)
+        target = self.tick + max(1, math.ceil(delay / self.resolution))
+        slot = target % self.size
+        self.slots[slot][key] = target
+        self.where[key] = slot
+
+    def cancel(self, key: typing.Hashable):
+        slot = self.where.pop(key, None)
+        if slot is not None:
+            del self.slots[slot][key]
+
+    def advance(self) -> list[typing.Hashable]:
+        self.tick += 1
+        bucket = self.slots[self.tick % self.size]
+        expired = [key for key, target in bucket.items() if target <= self.tick]
+        for key in expired:
+            del bucket[key]
+            del self.where[key]
+        return expired
+
+
+class HeartbeatScheduler:
+    def __init__(self, consul):
+        self.consul = consul
+        config = consul.config["heartbeat"]
+        self.timeout = float(config["hb-timeout"]) / 1000
+        self.wheel = TimerWheel(
+            float(config.get("hb-wheel-resolution", 50)) / 1000, int(config.get("hb-wheel-slots", 512))
+        )
+        self.grace: set = set()
+        self.timeouts = 0
+        self.acks = 0
+        self.suppressed = 0
+
+    def register(self, session):
+        self.wheel.schedule(session, session.ht_base.heartbeat_interval_in_seconds)
+
+    def unregister(self, session):
+        self.wheel.cancel(session)
+        self.grace.discard(session)
+
+    def beat(self, session):
+        session.heartbeat_seen = True
+        if session in self.grace:
+            self.acknowledge(session)
+
+    def activity(self, session):
+        session.data_seen = True
+        if session in self.grace:
+            self.suppress(session)
+
+    def acknowledge(self, session):
+        session.heartbeat_seen = False
+        self.grace.discard(session)
+        self.acks += 1
+        session.ht_base.heartbeat()
+        session.push(hiredis.pack_command(("HEARTBEAT", "ACK", f"{session.ht_base.heartbeat_interval}")))
+        self.wheel.schedule(session, session.ht_base.heartbeat_interval_in_seconds)
+
+    def suppress(self, session):
+        session.data_seen = False
+        session.heartbeat_seen = False
+        self.grace.discard(session)
+        self.suppressed += 1
+        self.wheel.schedule(session, session.ht_base.heartbeat_interval_in_seconds)
+
+    def expire(self, session):
+        if session.data_seen:
+            self.suppress(session)
+        elif session.heartbeat_seen:
+            self.acknowledge(session)
+        elif session not in self.grace:
+            self.grace.add(session)
+            self.wheel.schedule(session, self.timeout)
+        else:
+            self.grace.discard(session)
+            self.timeouts += 1
+            session.timeout()
+
+    async def run(self):
+        deadline = trio.current_time()
+        while True:
+            deadline += self.wheel.resolution
+            await trio.sleep_until(deadline)
+            behind = max(0, int((trio.current_time() - deadline) / self.wheel.resolution))
+            deadline += behind * self.wheel.resolution
+            for _ in range(behind + 1):
+                for session in self.wheel.advance():
+                    self.expire(session)
@@ -0,0 +1,125 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import bisect
+import itertools
+import typing
+
+import sentry_sdk
+
+
+class Histogram:
+    __slots__ = ("sub_bits", "counts", "count", "total", "max")
+
+    def __init__(self, sub_bits: int = 5, max_bits: int = 40):
+        self.sub_bits = sub_bits
+        self.counts = [0] * (((max_bits - sub_bits + 1) << sub_bits) + (1 << sub_bits))
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def _upper(self, index: int) -> int:
+        shift = index >> self.sub_bits
+        if not shift:
+            return index
+        return ((index & ((1 << self.sub_bits) - 1)) + 1) << shift
+
+    def record(self, value: int):
+        if value < 0:
+            value = 0
+        shift = value.bit_length() - self.sub_bits
+        index = value if shift <= 0 else (shift << self.sub_bits) + (value >> shift)
+        counts = self.counts
+        if index >= len(counts):
+            index = len(counts) - 1
+        counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: "Histogram"):
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q: float) -> int:
+        return self.percentiles((q,))[0]
+
+    def percentiles(self, qs: typing.Sequence[float]) -> list[int]:
+        if not self.count:
+            return [0] * len(qs)
+        cumulative = list(itertools.accumulate(self.counts))
+        return [
+            min(self._upper(bisect.bisect_left(cumulative, max(q / 100 * self.count, 1))), self.max) for q in qs
+        ]
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set_tag(self, key, value):
+        pass
+
+    def set_data(self, key, value):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Metrics:
+    percentiles = (("p50", 50), ("p99", 99), ("p999", 99.9))
+    quantiles = tuple(q for _, q in percentiles)
+
+    def __init__(self, trace_rate: float = 0.0):
+        self.counters: dict[str, int] = {}
+        self.histograms: dict[str, Histogram] = {}
+        self.trace_every = round(1 / trace_rate) if trace_rate > 0 else 0
+        self.countdown = self.trace_every
+
+    def histogram(self, name: str) -> Histogram:
+        hist = self.histograms.get(name)
+        if hist is None:
+            hist = self.histograms[name] = Histogram()
+        return hist
+
+    def record(self, name: str, value: int):
+        hist = self.histograms.get(name)
+        if hist is None:
+            hist = self.histograms[name] = Histogram()
+        hist.record(value)
+
+    def incr(self, name: str, value: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def trace(self, op: str, name: str):
+        if not self.trace_every:
+            return NULL_SPAN
+        self.countdown -= 1
+        if self.countdown > 0:
+            return NULL_SPAN
+        self.countdown = self.trace_every
+        self.counters["traces_sampled"] = self.counters.get("traces_sampled", 0) + 1
+        return sentry_sdk.start_transaction(op=op, name=name, sampled=True)
+
+    def summaries(self) -> dict[str, float]:
+        res: dict[str, float] = {}
+        for name, hist in self.histograms.items():
+            res[f"{name}_count"] = hist.count
+            for (label, _), value in zip(self.percentiles, hist.percentiles(self.quantiles)):
+                res[f"{name}_{label}_ms"] = value / 1e6
+            res[f"{name}_max_ms"] = hist.max / 1e6
+        return res
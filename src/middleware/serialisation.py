@@ -5,14 +5,12 @@
 import functools
 import json
 import os
-import time
 import typing
 from dataclasses import dataclass
-from typing import Any
 
 import hiredis
-import sentry_sdk
 
+from src.errors import ArgumentError
 from src.middleware.abc_mil import MIL
 
 
@@ -39,10 +37,132 @@ class Command:
     next: typing.Union[SubCommand, Data, End]
 
 
+_TRUE = frozenset(("1", "true", "yes", "on"))
+_FALSE = frozenset(("0", "false", "no", "off"))
+
+
+def _to_bool(value: str) -> bool:
+    lowered = value.lower()
+    if lowered in _TRUE:
+        return True
+    if lowered in _FALSE:
+        return False
+    raise ValueError(value)
+
+
+def _to_bytes(value: str) -> bytes:
+    return value.encode("utf-8", "surrogateescape")
+
+
+def _to_enum(choices: typing.Iterable[str]) -> typing.Callable[[str], str]:
+    allowed = frozenset(choices)
+
+    def convert(value: str) -> str:
+        if value not in allowed:
+            raise ValueError(value)
+        return value
+
+    return convert
+
+
+_CONVERTERS: dict[str, typing.Callable[[str], typing.Any]] = {
+    "int"   : int,
+    "float" : float,
+    "bool"  : _to_bool,
+    "bytes" : _to_bytes,
+    "str"   : str,
+    "string": str,
+}
+
+
+class ArgSpec:
+    __slots__ = ("name", "type", "convert", "required", "default", "variadic")
+
+    def __init__(self, arg: dict):
+        self.name = arg["name"]
+        self.type = arg.get("type", "str")
+        if self.type == "enum":
+            self.convert = _to_enum(arg["enum"])
+        elif self.type in _CONVERTERS:
+            self.convert = _CONVERTERS[self.type]
+        else:
+            raise ValueError(f"Unknown argument type {self.type!r} for {self.name!r}")
+        self.required = bool(arg.get("required", True))
+        self.default = arg.get("default")
+        self.variadic = bool(arg.get("variadic", False))
+
+
+class CommandSpec:
+    __slots__ = ("name", "sub", "key", "function", "args", "min_args", "max_args", "risk", "coalesce")
+
+    def __init__(
+        self,
+        name: str,
+        sub: typing.Optional[str],
+        function: str,
+        args: typing.Optional[list],
+        risk: int = 0,
+        coalesce: bool = False
+    ):
+        self.name = name
+        self.sub = sub
+        self.key = f"{name}_{sub}" if sub else name
+        self.function = function
+        self.risk = risk
+        self.coalesce = coalesce
+        self.args = tuple(ArgSpec(arg) for arg in args or ())
+        if any(arg.variadic for arg in self.args[:-1]):
+            raise ValueError(f"Only the last argument of {self.key!r} can be variadic")
+        self.min_args = sum(arg.required for arg in self.args)
+        self.max_args = None if self.args and self.args[-1].variadic else len(self.args)
+
+    def coerce(self, raw: tuple) -> tuple:
+        if len(raw) < self.min_args:
+            raise ArgumentError(f"'{self.key}' expects at least {self.min_args} arguments, got {len(raw)}")
+        if self.max_args is not None and len(raw) > self.max_args:
+            raise ArgumentError(f"'{self.key}' expects at most {self.max_args} arguments, got {len(raw)}")
+        res = []
+        for i, arg in enumerate(self.args):
+            values = raw[i:] if arg.variadic else raw[i:i + 1]
+            if not values:
+                if not arg.variadic:
+                    res.append(arg.default)
+                continue
+            for value in values:
+                try:
+                    res.append(arg.convert(value))
+                except (ValueError, TypeError, AttributeError):
+                    raise ArgumentError(f"'{arg.name}' of '{self.key}' must be {arg.type}, got {value!r}") from None
+        return tuple(res)
+
+
+class Request:
+    __slots__ = ("this", "sub", "args", "spec", "error")
+
+    def __init__(
+        self,
+        this: str,
+        sub: typing.Optional[str],
+        args: tuple,
+        spec: typing.Optional[CommandSpec],
+        error: typing.Optional[str] = None
+    ):
+        self.this = this
+        self.sub = sub
+        self.args = args
+        self.spec = spec
+        self.error = error
+
+
+def invalid_request(frame) -> Request:
+    return Request("", None, (frame,), None, "invalid request, expected an array of bulk strings")
+
+
 class Serialiser:
     def __init__(self):
         self.commands = {}
         self.args = {}
+        self.table: dict[tuple[str, typing.Optional[str]], CommandSpec] = {}
         self._update()
 
     def _update(self):
@@ -64,10 +184,18 @@ class Serialiser:
             cmd_info.update(json.load(f))
 
         self._register_command(
-            cmd_name, sub_cmd_name, cmd_info[cmd]["function"], cmd_info[cmd]["args"]
+            cmd_name,
+            sub_cmd_name,
+            cmd_info[cmd]["function"],
+            cmd_info[cmd]["args"],
+            cmd_info[cmd].get("risk", 0),
+            cmd_info[cmd].get("coalesce", False)
         )
 
-    def _register_command(self, cmd_name, sub_cmd_name, function, args):
+    def _register_command(self, cmd_name, sub_cmd_name, function, args, risk=0, coalesce=False):
+        self.table[(cmd_name, sub_cmd_name)] = CommandSpec(
+            cmd_name, sub_cmd_name, function, args, int(risk), bool(coalesce)
+        )
         if sub_cmd_name:
             self._register_sub_command(cmd_name, sub_cmd_name, function, args)
         else:
@@ -89,16 +217,27 @@ class Serialiser:
             self.args.setdefault(cmd_name, {0: None, 1: {}})
             self.args[cmd_name][1][sub_cmd_name] = {arg["name"]: arg for arg in args}
 
-    @sentry_sdk.trace
+    def parse(self, *request: str) -> Request:
+        try:
+            cmd = request[0].lower()
+            spec = self.table.get((cmd, request[1].lower())) if len(request) > 1 else None
+        except (IndexError, AttributeError):
+            return invalid_request(list(request))
+        raw = request[2:] if spec is not None else request[1:]
+        if spec is None:
+            spec = self.table.get((cmd, None))
+            if spec is None:
+                return Request(cmd, None, raw, None)
+        try:
+            return Request(cmd, spec.sub, spec.coerce(raw), spec)
+        except ArgumentError as err:
+            return Request(cmd, spec.sub, raw, spec, str(err))
+
     @functools.lru_cache()
     def convert_request(
         self, *request: str, recursive: bool = False
     ) -> typing.Union[Command, SubCommand, Data, End]:
-        ts = time.perf_counter_ns()
         if len(request) == 0:
-            sentry_sdk.set_measurement(
-                "serialisation", (time.perf_counter_ns() - ts) / 1000000, "miliseconds"
-            )
             return End()
         elif not recursive:
             cmd = request[0].lower()
@@ -106,39 +245,24 @@ class Serialiser:
                 return Command(this="not found", next=Data(this=cmd, next=End()))
 
             if len(request) == 1:
-                sentry_sdk.set_measurement(
-                    "serialisation", (time.perf_counter_ns() - ts) / 1000000, "miliseconds"
-                )
                 return Command(this=cmd, next=End())
 
             if len(request) == 2:
                 sub_cmd = request[1]
                 if sub_cmd in self.commands[cmd][1]:
-                    sentry_sdk.set_measurement(
-                        "serialisation", (time.perf_counter_ns() - ts) / 1000000, "miliseconds"
-                    )
                     return Command(this=cmd, next=SubCommand(this=sub_cmd, next=End()))
                 else:
-                    sentry_sdk.set_measurement(
-                        "serialisation", (time.perf_counter_ns() - ts) / 1000000, "miliseconds"
-                    )
                     return Command(this=cmd, next=Data(this=sub_cmd, next=End()))
 
             data = request[1:]
             sub_cmd = request[1]
             if sub_cmd in self.commands[cmd][1]:
-                sentry_sdk.set_measurement(
-                    "serialisation", (time.perf_counter_ns() - ts) / 1000000, "miliseconds"
-                )
                 return Command(
                     this=cmd,
                     next=SubCommand(
                         sub_cmd, next=self.convert_request(*data[1:], recursive=True)
                     )
                 )
-            sentry_sdk.set_measurement(
-                "serialisation", (time.perf_counter_ns() - ts) / 1000000, "miliseconds"
-            )
             return Command(
                 this=cmd,
                 next=Data(
@@ -147,29 +271,25 @@ class Serialiser:
             )
         else:
             data = request[1:]
-            sentry_sdk.set_measurement(
-                "serialisation", (time.perf_counter_ns() - ts) / 1000000, "miliseconds"
-            )
             return Data(
                 this=request[0], next=self.convert_request(*data, recursive=True)
             )
 
 
 class ReaderMIL(MIL):
-    def __init__(self):
-        self.r = hiredis.Reader(encoding="utf-8")
-
-    @sentry_sdk.trace
-    @functools.lru_cache()
-    def handle(self, request) -> list[str]:
-        self.r.feed(request)
-        return self.r.gets()
+    def handle(self, request: tuple[hiredis.Reader, bytes]) -> list[list[str]]:
+        reader, chunk = request
+        reader.feed(chunk)
+        frames = []
+        while (frame := reader.gets()) is not False:
+            frames.append(frame)
+        return frames
 
 
 class SerialiserMIL(MIL):
     def __init__(self):
         self.s = Serialiser()
 
-    @sentry_sdk.trace
-    def handle(self, request) -> Any:
-        return self.s.convert_request(*request)
+    def handle(self, request) -> list[Request]:
+        parse = self.s.parse
+        return [parse(*frame) if frame.__class__ is list else invalid_request(frame) for frame in request]
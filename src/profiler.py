@@ -0,0 +1,104 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import collections
+import itertools
+import sys
+import threading
+import time
+import traceback
+
+import trio
+
+
+class SlowStep:
+    __slots__ = ("id", "timestamp", "duration_us", "task", "stack")
+
+    def __init__(self, id: int, timestamp: int, duration_us: int, task: str, stack: list[str]):
+        self.id = id
+        self.timestamp = timestamp
+        self.duration_us = duration_us
+        self.task = task
+        self.stack = stack
+
+    def as_dict(self) -> dict:
+        return {
+            "id"         : self.id,
+            "timestamp"  : self.timestamp,
+            "duration_us": self.duration_us,
+            "task"       : self.task,
+            "stack"      : self.stack,
+        }
+
+
+class LoopProfiler(trio.abc.Instrument):
+    def __init__(self, metrics, threshold: float, size: int, depth: int = 24):
+        self.metrics = metrics
+        self.threshold_ns = int(threshold * 1e9)
+        self.depth = depth
+        self.slowlog: collections.deque[SlowStep] = collections.deque(maxlen=size)
+        self.ids = itertools.count()
+        self.steps = itertools.count()
+        self.scheduled: dict[trio.lowlevel.Task, int] = {}
+        self.step: tuple[int, int] = (-1, 0)
+        self.samples: dict[int, list[str]] = {}
+        self.loop_thread = threading.get_ident()
+        self.stopped = threading.Event()
+        self.watchdog = threading.Thread(target=self.watch, name="clousocket-loop-watchdog", daemon=True)
+
+    def start(self):
+        self.loop_thread = threading.get_ident()
+        trio.lowlevel.add_instrument(self)
+        self.watchdog.start()
+
+    def close(self):
+        self.stopped.set()
+        try:
+            trio.lowlevel.remove_instrument(self)
+        except (KeyError, RuntimeError):
+            pass
+
+    def watch(self):
+        interval = self.threshold_ns / 2e9
+        while not self.stopped.wait(interval):
+            step, started = self.step
+            if started and step not in self.samples and time.perf_counter_ns() - started > self.threshold_ns:
+                frame = sys._current_frames().get(self.loop_thread)
+                if frame is not None:
+                    self.samples[step] = traceback.format_stack(frame)[-self.depth:]
+                    if self.step[0] != step:
+                        self.samples.pop(step, None)
+
+    def task_scheduled(self, task):
+        self.scheduled[task] = time.perf_counter_ns()
+
+    def task_exited(self, task):
+        self.scheduled.pop(task, None)
+
+    def before_task_step(self, task):
+        now = time.perf_counter_ns()
+        scheduled = self.scheduled.pop(task, None)
+        if scheduled is not None:
+            self.metrics.record("task_schedule_lag", now - scheduled)
+        self.step = (next(self.steps), now)
+
+    def after_task_step(self, task):
+        step, started = self.step
+        if not started:
+            return
+        self.step = (-1, 0)
+        duration = time.perf_counter_ns() - started
+        self.metrics.record("task_step", duration)
+        stack = self.samples.pop(step, None)
+        if duration < self.threshold_ns:
+            return
+        if stack is None:
+            stack = [
+                f'  File "{frame.f_code.co_filename}", line {lineno}, in {frame.f_code.co_name}\n'
+                for frame, lineno in task.iter_await_frames()
+            ][-self.depth:]
+        self.slowlog.appendleft(SlowStep(next(self.ids), int(time.time()), duration // 1000, task.name, stack))
+
+    def reset(self):
+        self.slowlog.clear()
@@ -2,54 +2,214 @@
 #  Copyright (C) 2024-present Lovania
 #
 
+import contextvars
+import itertools
 import time
-import uuid
+import typing
 
 import redio
 import sentry_sdk
 import trio
+from redio.exc import ProtocolError, ServerError
 
-from src.utils import IOQueue
+from src.caching import ClientCache, InvalidationListener, written_keys
+from src.errors import AbortedReadError, QueueFullError
+from src.utils import IOQueue, ReplySlot
+
+READ_COMMANDS = frozenset((
+    "GET", "MGET", "STRLEN", "GETRANGE", "EXISTS", "TYPE", "TTL", "PTTL",
+    "HGET", "HMGET", "HGETALL", "HEXISTS", "HLEN", "HKEYS", "HVALS",
+    "LLEN", "LINDEX", "LRANGE", "SCARD", "SISMEMBER", "SMEMBERS",
+    "ZCARD", "ZSCORE", "ZRANGE", "ZRANK",
+))
+
+coalesce_reads: contextvars.ContextVar[bool] = contextvars.ContextVar("coalesce_reads", default=False)
+
+
+class ReadCoalescer:
+    def __init__(self, db, window: float):
+        self.db = db
+        self.window = window
+        self.inflight: dict[tuple, ReplySlot] = {}
+        self.gets: dict[str, ReplySlot] = {}
+
+    @staticmethod
+    def accepts(inp) -> bool:
+        return inp[0].upper() in READ_COMMANDS
+
+    async def execute(self, *inp):
+        if len(inp) == 2 and inp[0].upper() == "GET":
+            return await self.get(inp[1])
+        slot = self.inflight.get(inp)
+        if slot is not None:
+            return await slot.wait()
+        slot = self.inflight[inp] = ReplySlot()
+        try:
+            res = await self.db.submit(*inp)
+        except Exception as err:
+            slot.fail(err)
+            raise
+        except BaseException:
+            slot.fail(AbortedReadError(inp[0]))
+            raise
+        else:
+            slot.resolve(res)
+            return res
+        finally:
+            del self.inflight[inp]
+
+    async def get(self, key):
+        slot = self.gets.get(key)
+        if slot is None:
+            slot = self.gets[key] = ReplySlot()
+            if len(self.gets) == 1:
+                trio.lowlevel.spawn_system_task(self.flush)
+        return await slot.wait()
+
+    async def flush(self):
+        await trio.sleep(self.window)
+        batch, self.gets = self.gets, {}
+        try:
+            if len(batch) == 1:
+                res = [await self.db.submit("GET", *batch)]
+            else:
+                res = await self.db.submit("MGET", *batch)
+            if not isinstance(res, list) or len(res) != len(batch):
+                raise ProtocolError(f"MGET of {len(batch)} keys answered with {res!r}")
+        except Exception as err:
+            for slot in batch.values():
+                slot.fail(err)
+            return
+        except BaseException:
+            for slot in batch.values():
+                slot.fail(AbortedReadError("MGET"))
+            raise
+        for slot, data in zip(batch.values(), res):
+            slot.resolve(data)
 
 
 class RedisTPCS:
     def __init__(self, consul):
         self.consul = consul
         self.max_conns = int(self.consul.config["redis"]["max-connections"])
-        self.in_queue = IOQueue()
-        self.out_queue = IOQueue()
+        self.batch_size = max(1, int(self.consul.config["redis"].get("batch-size", 64)))
+        self.batch_linger = float(self.consul.config["redis"].get("batch-linger", 0)) / 1000
+        self.in_queue = IOQueue.from_config(self.consul.config["redis"], on_drop=self._drop)
+        self.pending: dict[int, ReplySlot] = {}
+        self.ids = itertools.count()
         self.pool = redio.Redis(self.consul.config["redis"]["url"], pool_max=self.max_conns)
+        self.coalescer = ReadCoalescer(
+            self, float(self.consul.config["redis"].get("coalesce-window", 1)) / 1000
+        )
+        self.cache = ClientCache(self.consul.cache, self.consul.config["caching"])
 
-    async def execute(self, *inp):
-        with sentry_sdk.start_transaction(op="subprocess.communicate", name="Database Command Process"):
-            pid = uuid.uuid1()
+    async def execute(self, *inp, coalesce: typing.Optional[bool] = None):
+        if coalesce is None:
+            coalesce = coalesce_reads.get()
+        if not self.cache.enabled:
+            return await self.dispatch(inp, coalesce)
+        if len(inp) == 2 and inp[0].upper() == "GET":
+            found, res = self.cache.lookup(inp[1])
+            if found:
+                return res
+            version = self.cache.begin(inp[1])
+            try:
+                res = await self.dispatch(inp, coalesce)
+                self.cache.store(inp[1], res, version)
+            finally:
+                self.cache.release(inp[1])
+            return res
+        keys = written_keys(inp)
+        if keys == ():
+            return await self.dispatch(inp, coalesce)
+        self._invalidate(keys)
+        try:
+            return await self.dispatch(inp, coalesce)
+        finally:
+            # A GET on another connection may have read the old value while the write was in flight.
+            self._invalidate(keys)
+
+    def _invalidate(self, keys: typing.Optional[tuple]):
+        if keys is None:
+            self.cache.flush()
+        else:
+            self.cache.invalidate(*keys)
+
+    async def dispatch(self, inp: tuple, coalesce: bool):
+        if coalesce and self.coalescer.accepts(inp):
+            return await self.coalescer.execute(*inp)
+        return await self.submit(*inp)
+
+    async def submit(self, *inp):
+        pid = next(self.ids)
+        slot = self.pending[pid] = ReplySlot()
+        try:
             await self.in_queue.append(inp, pid)
-            async for data, cid in self.out_queue:
-                if cid == pid:
-                    return data
+            return await slot.wait()
+        finally:
+            del self.pending[pid]
+
+    def _resolve(self, cid, res):
+        slot = self.pending.get(cid)
+        if slot is not None:
+            slot.resolve(res)
+
+    def _fail(self, cid, err):
+        slot = self.pending.get(cid)
+        if slot is not None:
+            slot.fail(err)
+
+    def _drop(self, _, cid):
+        self._fail(cid, QueueFullError())
 
     async def starter(self):
         for _ in range(self.max_conns):
             trio.lowlevel.spawn_system_task(self.executor)
+        if self.cache.enabled and self.cache.mode == "tracking":
+            listener = InvalidationListener(self.cache, self.consul.config["redis"]["url"])
+            trio.lowlevel.spawn_system_task(listener.starter)
+
+    async def collect(self):
+        try:
+            batch = [await self.in_queue.recv_io_stream()]
+        except trio.EndOfChannel:
+            return []
+        batch.extend(self.in_queue.drain(self.batch_size - 1))
+        if len(batch) < self.batch_size and self.batch_linger:
+            with trio.move_on_after(self.batch_linger):
+                try:
+                    while len(batch) < self.batch_size:
+                        batch.append(await self.in_queue.recv_io_stream())
+                        batch.extend(self.in_queue.drain(self.batch_size - len(batch)))
+                except trio.EndOfChannel:
+                    pass
+        return batch
 
     async def executor(self):
-        async for comm, cid in self.in_queue:
+        while batch := await self.collect():
             ts = time.perf_counter_ns()
-            with sentry_sdk.start_transaction(op="db.redis", name="Database Command Exec.") as trs:
+            with self.consul.metrics.trace("db.redis", "Database Command Exec.") as trs:
                 conn = self.pool()
                 try:
-                    res = await conn._command(*comm).autodecode
-                    await self.out_queue.append(res, cid)
-                    te = (time.perf_counter_ns() / 1000000) - ts / 1000000
-                    sentry_sdk.set_measurement('redis_command_exec', te, 'miliseconds')
-                    sentry_sdk.metrics.distribution(
-                        key="database_command_exec_time",
-                        value=te,
-                        unit="millisecond"
-                    )
+                    for comm, _ in batch:
+                        conn = conn._command(*comm)
+                    res = await conn.autodecode
+                    if len(batch) == 1:
+                        res = [res]
+                    for (_, cid), data in zip(batch, res):
+                        if isinstance(data, ServerError):
+                            self._fail(cid, data)
+                        else:
+                            self._resolve(cid, data)
+                    self.consul.metrics.record("stage_redis", time.perf_counter_ns() - ts)
+                    self.consul.metrics.incr("redis_batches")
+                    self.consul.metrics.incr("redis_commands", len(batch))
                 except Exception as err:
                     sentry_sdk.capture_exception(err)
+                    for _, cid in batch:
+                        self._fail(cid, err)
                     continue
                 finally:
                     del conn
-                    trs.set_tag("command", comm[0])
+                    trs.set_tag("command", batch[0][0][0])
+                    trs.set_tag("batch_size", len(batch))
@@ -2,27 +2,54 @@
 #  Copyright (C) 2024-present Lovania
 #
 
+import socket
+
 import sentry_sdk
 import trio
 
 from src import consul
+from src.supervisor import Supervisor
+
 
+async def open_reuseport_listener(host: str, port: int) -> trio.SocketListener:
+    sock = trio.socket.socket(trio.socket.AF_INET, trio.socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    await sock.bind((host, port))
+    sock.listen(socket.SOMAXCONN)
+    return trio.SocketListener(sock)
 
-async def server():
-    async with consul.SupremeConsul() as cn:
-        print(f"Redis {await cn.db.execute('GET', 'init')}ialized successfully.")
+
+async def server(worker_id=None, reports=None):
+    async with consul.SupremeConsul(worker_id, reports) as cn:
+        print(f"Redis {await cn.db.execute('GET', 'init', coalesce=True)}ialized successfully.")
 
         try:
             async with trio.open_nursery() as nursery:
-                await nursery.start(trio.serve_tcp, cn.create_session, cn.port)
+                if worker_id is None:
+                    await nursery.start(trio.serve_tcp, cn.create_session, cn.port)
+                else:
+                    listener = await open_reuseport_listener(cn.host, cn.port)
+                    await nursery.start(trio.serve_listeners, cn.create_session, [listener])
         except* KeyboardInterrupt:
             raise KeyboardInterrupt()
         except* Exception as err:
             sentry_sdk.capture_exception(err)
 
 
+def worker(worker_id, reports):
+    try:
+        trio.run(server, worker_id, reports)
+    except* KeyboardInterrupt:
+        pass
+
+
 if __name__ == "__main__":
+    config = consul.load_config()
     try:
-        trio.run(server)
+        if int(config["network"].get("workers", 1)) > 1:
+            Supervisor(config, worker).run()
+        else:
+            trio.run(server)
     except* KeyboardInterrupt:
         print("Closed")
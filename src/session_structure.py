@@ -8,96 +8,194 @@ import hiredis
 import sentry_sdk
 import trio
 
-
-class HeatbeatTimeoutError(Exception):
-    pass
+from src.capture import CLOSE, DATA
+from src.errors import OverloadError
+from src.utils import resp_error
 
 
 class HeartbeatBase:
     def __init__(self, config):
         self.config: dict = config
         self.min_heartbeat = float(self.config["heartbeat"]["hb-min-interval"])
-        self.max_heartbeat = float(self.config["heartbeat"]["hb-max-interval"])
+        timeout = float(self.config["heartbeat"]["hb-timeout"])
+        deadline = float(self.config["heartbeat"].get("hb-detection-deadline", 10000))
+        # A peer can die right after beating: it then goes unnoticed for the interval it beat in, the next one
+        # and the timeout.
+        self.max_heartbeat = max(
+            self.min_heartbeat, min(float(self.config["heartbeat"]["hb-max-interval"]), (deadline - timeout) / 2)
+        )
         self.init_heartbeat_interval = float(self.config["heartbeat"]["hb-init-interval"])
-        self.heartbeat_interval = self.init_heartbeat_interval
+        self.backoff = float(self.config["heartbeat"].get("hb-backoff", 1.5))
+        self.alpha = float(self.config["heartbeat"].get("hb-ewma-alpha", 0.2))
+        self.heartbeat_interval = self._clamp(self.init_heartbeat_interval)
         self.heartbeat_interval_in_seconds = self.heartbeat_interval / 1000
-        self.last_activity_ts = 0
-
-    async def update_heartbeat(self):
-        current_time = time.perf_counter()
-        elapsed_time = current_time - self.last_activity_ts
-        new_interval = max(self.min_heartbeat, self.init_heartbeat_interval + elapsed_time)
-        new_interval = min(new_interval, self.max_heartbeat)
-        self.heartbeat_interval = new_interval
-        self.last_activity_ts = current_time
-
-    async def heartbeat(self):
-        if not self.last_activity_ts:
-            self.last_activity_ts = time.perf_counter()
-        await self.update_heartbeat()
+        self.inter_arrival = self.heartbeat_interval
+        self.last_activity_ts = 0.0
+
+    def _clamp(self, interval: float) -> float:
+        return min(max(interval, self.min_heartbeat), self.max_heartbeat)
+
+    def _set_interval(self, interval: float):
+        self.heartbeat_interval = self._clamp(interval)
         self.heartbeat_interval_in_seconds = self.heartbeat_interval / 1000
 
+    def observe(self, now: float):
+        if self.last_activity_ts:
+            gap = (now - self.last_activity_ts) * 1000
+            self.inter_arrival += self.alpha * (gap - self.inter_arrival)
+        self.last_activity_ts = now
+
+    def update_heartbeat(self):
+        self._set_interval(max(self.inter_arrival, self.heartbeat_interval * self.backoff))
+
+    def heartbeat(self):
+        self.update_heartbeat()
+
 
 class Session:
     def __init__(self, proto: trio.SocketStream, consul, consular):
         self.last_activity_ts = None
         self.proto: trio.SocketStream = proto
         self.ht_base = HeartbeatBase(consul.config)
-        self.heartbeat_timeout = int(consul.config["heartbeat"]["hb-timeout"])
-        self.heartbeat_future = trio.Event()
+        self.heartbeat_seen = False
+        self.data_seen = False
+        self.rule_state: dict = {}
         self.consul = consul
         self.consular = consular
-        self.parser = hiredis.Reader()
+        # Bulk strings that are not UTF-8 keep their bytes as surrogates instead of failing the whole chunk.
+        self.parser = hiredis.Reader(encoding="utf-8", errors="surrogateescape")
+        self.inflight = trio.Semaphore(int(consul.config["network"].get("max-inflight", 64)))
+        self.replies: dict[int, bytes] = {}
+        self.oob: list[bytes] = []
+        self.next_seq = 0
+        self.flush_seq = 0
+        self.closing = False
+        self.aborting = False
+        self.flush_event = trio.Event()
+        self.capture_id = 0
 
     def between_callback(self):
         trio.from_thread.run(self.basis)
 
     async def basis(self):
+        recorder = self.consul.recorder
+        if recorder is not None:
+            self.capture_id = recorder.open()
         async with self.consular as cnslr:
             try:
                 async with trio.open_nursery() as nursery:
                     cnslr.set_nursery(nursery)
-                    nursery.start_soon(self.heartbeat)
+                    self.consul.heartbeats.register(self)
+                    nursery.start_soon(self.writer)
                     nursery.start_soon(self.io)
-            except* HeatbeatTimeoutError:
-                await self.proto.send_all(hiredis.pack_command(("HEARTBEAT", "TIMEOUT")))
-                nursery.cancel_scope.cancel()
             except* trio.BrokenResourceError:
                 ...
+            except* Exception as err:
+                sentry_sdk.capture_exception(err)
             finally:
+                self.consul.heartbeats.unregister(self)
+                if recorder is not None:
+                    recorder.record(self.capture_id, CLOSE, b"")
                 await self.proto.aclose()
 
-    async def heartbeat(self):
+    def push(self, frame: bytes):
+        self.oob.append(frame)
+        self.flush_event.set()
+
+    def reply(self, seq: int, frame: bytes):
+        self.replies[seq] = frame
+        self.flush_event.set()
+
+    def close(self):
+        self.closing = True
+        self.flush_event.set()
+
+    def timeout(self):
+        self.aborting = True
+        self.push(hiredis.pack_command(("HEARTBEAT", "TIMEOUT")))
+        self.consular.nursery.cancel_scope.deadline = trio.current_time() + self.consul.heartbeats.timeout
+
+    async def writer(self):
         while True:
-            await trio.sleep(self.ht_base.heartbeat_interval_in_seconds)
-            try:
-                with trio.move_on_after(self.heartbeat_timeout / 1000) as scope:
-                    await self.heartbeat_future.wait()
-                    await self.ht_base.heartbeat()
-                    await self.proto.send_all(
-                        hiredis.pack_command(("HEARTBEAT", "ACK", f"{self.ht_base.heartbeat_interval}")))
-                if scope.cancelled_caught:
-                    raise TimeoutError()
-            except TimeoutError:
-                break
-        raise HeatbeatTimeoutError("Heartbeat timed out")
+            await self.flush_event.wait()
+            self.flush_event = trio.Event()
+            frames, self.oob = self.oob, []
+            while self.flush_seq in self.replies:
+                frames.append(self.replies.pop(self.flush_seq))
+                self.flush_seq += 1
+            if frames:
+                await self.proto.send_all(b"".join(frames))
+            if self.aborting or (self.closing and self.flush_seq == self.next_seq):
+                self.consular.nursery.cancel_scope.cancel()
+                return
+
+    async def dispatch(self, seq: int, request):
+        frame = b""
+        try:
+            frame = await self.handler(request) or b""
+        except Exception as err:
+            sentry_sdk.capture_exception(err)
+            self.consul.metrics.incr("command_errors")
+            frame = resp_error("ERR", f"internal error while running '{request.spec.key}'")
+        finally:
+            self.inflight.release()
+            self.reply(seq, frame)
 
     async def io(self):
-        async for message in self.proto:
-            with sentry_sdk.start_transaction(op="function", name="IO Middleware"):
-                req = await self.consul.middleware.handle(message)
-                if req.this == "not found":
-                    await self.proto.send_all(hiredis.pack_command(("ERR", "unknown", "command", f"'{req.next.this}'")))
-                    break
-                if req.this == "heartbeat":
-                    self.heartbeat_future.set()
-                    continue
-                self.ht_base.last_activity_ts = time.perf_counter()
-                await self.handler(req)
-
-    @sentry_sdk.trace
-    async def handler(self, request):
+        try:
+            metrics = self.consul.metrics
+            recorder = self.consul.recorder
+            async for chunk in self.proto:
+                if recorder is not None:
+                    recorder.record(self.capture_id, DATA, chunk)
+                with metrics.trace("function", "IO Middleware"):
+                    ts = time.perf_counter_ns()
+                    try:
+                        requests = await self.consul.middleware.handle((self.parser, chunk))
+                    except hiredis.ProtocolError:
+                        metrics.incr("protocol_errors")
+                        self.push(hiredis.pack_command(("ERR", "protocol", "error")))
+                        return
+                    metrics.record("stage_parse", time.perf_counter_ns() - ts)
+                    if requests:
+                        self.ht_base.observe(time.perf_counter())
+                    for req in requests:
+                        if req.error is not None:
+                            self.reply(self.next_seq, resp_error("ERR", req.error))
+                            self.next_seq += 1
+                            continue
+                        if req.spec is None:
+                            self.reply(
+                                self.next_seq, hiredis.pack_command(("ERR", "unknown", "command", f"{req.this!r}"))
+                            )
+                            self.next_seq += 1
+                            return
+                        if req.this == "heartbeat":
+                            self.consul.heartbeats.beat(self)
+                            continue
+                        self.consul.heartbeats.activity(self)
+                        if self.consul.gh.command_rules and not await self.consul.gh.check_command(self, req):
+                            self.reply(self.next_seq, resp_error("BUSY", "command refused by gatehouse"))
+                            self.next_seq += 1
+                            continue
+                        await self.inflight.acquire()
+                        self.consular.nursery.start_soon(self.dispatch, self.next_seq, req)
+                        self.next_seq += 1
+        finally:
+            self.close()
+
+    async def handler(self, request) -> bytes:
+        metrics = self.consul.metrics
         ts = time.perf_counter_ns()
-        te = time.perf_counter_ns()
-        self.last_activity_ts = time.perf_counter()
-        sentry_sdk.metrics.distribution(key="data_handling", value=(te - ts) / 1000000, unit="millisecond")
+        try:
+            return await self.consul.handler.handle(self.proto, request)
+        except KeyError:
+            metrics.incr("command_errors")
+            return hiredis.pack_command(("ERR", "unknown", "command", f"{request.this!r}"))
+        except OverloadError:
+            metrics.incr("command_errors")
+            return resp_error("BUSY", "server is overloaded, try again later")
+        finally:
+            te = time.perf_counter_ns()
+            self.last_activity_ts = time.perf_counter()
+            metrics.record(f"command_{request.spec.key}", te - ts)
@@ -0,0 +1,95 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import multiprocessing
+import queue
+import time
+import typing
+
+import sentry_sdk
+
+
+class WorkerSlot:
+    def __init__(self, worker_id: int):
+        self.worker_id = worker_id
+        self.process: typing.Optional[multiprocessing.Process] = None
+        self.started = 0.0
+        self.backoff = 0.0
+        self.restart_at = 0.0
+
+
+class Supervisor:
+    min_backoff = 0.5
+    max_backoff = 30.0
+    stable_after = 60.0
+
+    def __init__(self, config: dict, target: typing.Callable[[int, multiprocessing.Queue], None]):
+        self.config = config
+        self.target = target
+        self.count = int(config["network"]["workers"])
+        self.reports = multiprocessing.Queue()
+        self.slots = [WorkerSlot(i) for i in range(self.count)]
+        self.metrics: dict[int, dict[str, int]] = {}
+
+    def spawn(self, slot: WorkerSlot):
+        slot.process = multiprocessing.Process(
+            target=self.target, args=(slot.worker_id, self.reports), name=f"clousocket-worker-{slot.worker_id}"
+        )
+        slot.process.start()
+        slot.started = time.monotonic()
+
+    def reap(self, slot: WorkerSlot):
+        now = time.monotonic()
+        if slot.process.is_alive():
+            return
+        if not slot.restart_at:
+            if now - slot.started > self.stable_after:
+                slot.backoff = 0.0
+            slot.backoff = min(self.max_backoff, max(self.min_backoff, slot.backoff * 2))
+            slot.restart_at = now + slot.backoff
+            self.metrics.pop(slot.worker_id, None)
+            print(f"Worker {slot.worker_id} exited with {slot.process.exitcode}, restarting in {slot.backoff}s.")
+        elif now >= slot.restart_at:
+            slot.restart_at = 0.0
+            self.spawn(slot)
+
+    def collect(self):
+        while True:
+            try:
+                worker_id, snapshot = self.reports.get_nowait()
+            except queue.Empty:
+                break
+            self.metrics[worker_id] = snapshot
+
+    def aggregate(self) -> dict[str, int]:
+        res: dict[str, int] = {"workers_alive": sum(slot.process.is_alive() for slot in self.slots)}
+        for snapshot in self.metrics.values():
+            for key, value in snapshot.items():
+                if key.endswith(("_ms", "_rate", "_seconds")):
+                    res[key] = max(res.get(key, 0), value)
+                else:
+                    res[key] = res.get(key, 0) + value
+        return res
+
+    def run(self):
+        sentry_sdk.init(dsn=self.config["sentry"]["dsn"])
+        for slot in self.slots:
+            self.spawn(slot)
+        last_export = time.monotonic()
+        try:
+            while True:
+                time.sleep(0.5)
+                for slot in self.slots:
+                    self.reap(slot)
+                self.collect()
+                if time.monotonic() - last_export >= 2:
+                    last_export = time.monotonic()
+                    for key, value in self.aggregate().items():
+                        sentry_sdk.metrics.gauge(key=f"cluster_{key}", value=value)
+        finally:
+            for slot in self.slots:
+                if slot.process.is_alive():
+                    slot.process.terminate()
+            for slot in self.slots:
+                slot.process.join()
@@ -2,21 +2,129 @@
 #  Copyright (C) 2024-present Lovania
 #
 
+import collections
 import math
+import time
 
 import trio
 
+from src.errors import QueueFullError
+from src.metrics import Histogram
+
 
 class EndOfStream(Exception):
     pass
 
 
+def resp_error(kind: str, message: str) -> bytes:
+    return f"-{kind} {message}\r\n".encode()
+
+
+def resp_bulk(data: str) -> bytes:
+    payload = data.encode()
+    return b"$%d\r\n%s\r\n" % (len(payload), payload)
+
+
+def resp_encode(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, (list, tuple)):
+        return b"*%d\r\n" % len(value) + b"".join(resp_encode(item) for item in value)
+    if isinstance(value, str):
+        value = value.encode()
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+class ReplySlot:
+    __slots__ = ("event", "value", "error")
+
+    def __init__(self):
+        self.event = trio.Event()
+        self.value = None
+        self.error = None
+
+    def resolve(self, value):
+        self.value = value
+        self.event.set()
+
+    def fail(self, error: BaseException):
+        self.error = error
+        self.event.set()
+
+    async def wait(self):
+        await self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
 class IOQueue:
-    def __init__(self, limit=math.inf):
+    policies = ("block", "reject", "drop-oldest")
+
+    def __init__(self, limit=math.inf, policy: str = "block", on_drop=None):
+        if policy not in self.policies:
+            raise ValueError(f"Unknown queue policy {policy!r}")
+        self.limit = limit
+        self.policy = policy
+        self.on_drop = on_drop
         self.s_channel, self.r_channel = trio.open_memory_channel(limit)
+        self.received = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.wait_ns = 0
+        self.max_wait_ns = 0
+        self.waits = Histogram()
+        self.stamps: collections.deque[int] = collections.deque()
+
+    @classmethod
+    def from_config(cls, config: dict, on_drop=None):
+        size = int(config.get("queue-size", 0))
+        return cls(size if size > 0 else math.inf, config.get("queue-policy", "block"), on_drop)
+
+    @property
+    def depth(self) -> int:
+        return self.s_channel.statistics().current_buffer_used
+
+    @property
+    def sojourn(self) -> float:
+        if not self.stamps:
+            return 0.0
+        return (time.perf_counter_ns() - self.stamps[0]) / 1e9
 
     async def append(self, data, cid):
-        await self.s_channel.send([data, cid])
+        item = (data, cid, time.perf_counter_ns())
+        self.stamps.append(item[2])
+        if self.policy == "block":
+            try:
+                await self.s_channel.send(item)
+            except BaseException:
+                self.stamps.remove(item[2])
+                raise
+            return
+        try:
+            self.s_channel.send_nowait(item)
+        except trio.WouldBlock:
+            if self.policy == "reject":
+                self.stamps.remove(item[2])
+                self.rejected += 1
+                raise QueueFullError()
+            oldest = self.r_channel.receive_nowait()
+            self.stamps.popleft()
+            self.dropped += 1
+            self.s_channel.send_nowait(item)
+            if self.on_drop is not None:
+                self.on_drop(oldest[0], oldest[1])
+
+    def _received(self, item):
+        self.stamps.popleft()
+        waited = time.perf_counter_ns() - item[2]
+        self.received += 1
+        self.wait_ns += waited
+        self.max_wait_ns = max(self.max_wait_ns, waited)
+        self.waits.record(waited)
+        return [item[0], item[1]]
 
     async def __aiter__(self):
         try:
@@ -30,4 +138,25 @@ class IOQueue:
 
     async def recv_io_stream(self):
         res = await self.r_channel.receive()
+        return self._received(res)
+
+    def drain(self, limit):
+        res = []
+        while len(res) < limit:
+            try:
+                res.append(self._received(self.r_channel.receive_nowait()))
+            except (trio.WouldBlock, trio.EndOfChannel):
+                break
         return res
+
+    def statistics(self) -> dict[str, float]:
+        return {
+            "depth"      : self.depth,
+            "received"   : self.received,
+            "rejected"   : self.rejected,
+            "dropped"    : self.dropped,
+            "wait_avg_ms": self.wait_ns / self.received / 1e6 if self.received else 0.0,
+            "wait_max_ms": self.max_wait_ns / 1e6,
+            "wait_p50_ms": self.waits.percentile(50) / 1e6,
+            "wait_p99_ms": self.waits.percentile(99) / 1e6,
+        }
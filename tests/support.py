@@ -0,0 +1,37 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import contextlib
+import typing
+
+import cachebox
+import trio
+
+from src.bench.fake_redis import FakeRedis
+from src.metrics import Metrics
+from src.red_db import RedisTPCS
+
+
+class Consul:
+    """The parts of SupremeConsul that RedisTPCS reads."""
+
+    def __init__(self, url: str, redis: typing.Optional[dict] = None, caching: typing.Optional[dict] = None):
+        self.config = {
+            "redis"  : {"url": url, "max-connections": 4, **(redis or {})},
+            "caching": {"size": 1024, **(caching or {})},
+        }
+        self.cache = cachebox.LRUCache(self.config["caching"]["size"])
+        self.metrics = Metrics()
+
+
+@contextlib.asynccontextmanager
+async def fake_redis_db(redis: typing.Optional[dict] = None, caching: typing.Optional[dict] = None):
+    async with trio.open_nursery() as nursery:
+        fake = FakeRedis()
+        listeners = await nursery.start(fake.serve, 0)
+        port = listeners[0].socket.getsockname()[1]
+        db = RedisTPCS(Consul(f"redis://127.0.0.1:{port}/0", redis, caching))
+        await db.starter()
+        yield fake, db
+        nursery.cancel_scope.cancel()
@@ -0,0 +1,60 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import pytest
+import trio
+
+from src.errors import QueueFullError
+from src.gatehouse.admission import AdmissionController
+from src.utils import IOQueue
+
+
+def test_sojourn_grows_while_nothing_is_dequeued():
+    async def main():
+        queue = IOQueue()
+        assert queue.sojourn == 0.0
+        await queue.append("GET", 1)
+        await queue.append("GET", 2)
+        await trio.sleep(0.05)
+        assert queue.sojourn >= 0.05
+        queue.drain(1)
+        assert queue.sojourn >= 0.05
+        queue.drain(1)
+        assert queue.sojourn == 0.0
+
+    trio.run(main)
+
+
+def test_sojourn_forgets_dropped_and_rejected_items():
+    async def main():
+        dropping = IOQueue(1, "drop-oldest")
+        await dropping.append("GET", 1)
+        await trio.sleep(0.05)
+        await dropping.append("GET", 2)
+        assert dropping.sojourn < 0.05
+        assert len(dropping.stamps) == 1
+
+        rejecting = IOQueue(1, "reject")
+        await rejecting.append("GET", 1)
+        with pytest.raises(QueueFullError):
+            await rejecting.append("GET", 2)
+        assert len(rejecting.stamps) == 1
+
+    trio.run(main)
+
+
+def test_stalled_queue_sheds_new_connections():
+    async def main():
+        queue = IOQueue()
+        controller = AdmissionController({"latency-target": 5, "latency-interval": 20}, queue)
+        assert controller.admit()
+        await queue.append("GET", 1)
+        await trio.sleep(0.01)
+        assert controller.admit()
+        await trio.sleep(0.03)
+        assert not controller.admit()
+        queue.drain(1)
+        assert controller.admit()
+
+    trio.run(main)
@@ -0,0 +1,73 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import numpy as np
+import trio
+
+from src.gatehouse.rules.anomaly import Rule
+from tests.support import fake_redis_db
+
+
+class GridModel:
+    """Answers risks below 5 from the table and scores the rest as outliers."""
+
+    def lookup(self, risk: int, command_cn: int):
+        return False if risk < 5 else None
+
+    def predict(self, features: np.ndarray) -> np.ndarray:
+        return np.ones(len(features), dtype=bool)
+
+
+class Spec:
+    def __init__(self, risk: int):
+        self.risk = risk
+
+
+class Request:
+    def __init__(self, risk: int):
+        self.spec = Spec(risk)
+
+
+class Session:
+    def __init__(self):
+        self.rule_state = {}
+
+
+def learning_rule(db) -> Rule:
+    db.consul.config["gatehouse"] = {"anomaly": {"max-command-count": 10}}
+    db.consul.db = db
+    db.consul.limiter = trio.CapacityLimiter(1)
+    rule = Rule(db.consul)
+    rule.learning = True
+    rule.model = GridModel()
+    return rule
+
+
+def test_poll_labels_skips_malformed_entries():
+    async def main():
+        async with fake_redis_db() as (fake, db):
+            rule = learning_rule(db)
+            await db.execute("RPUSH", rule.label_key, "3 4 1", "5", "[1, 2]", "a b c", "1 2", "-1 2 0", "9 40 0")
+            await rule.poll_labels()
+            assert rule.reservoir.items == [(3, 4, 1), (9, 10, 0)]
+            assert rule.labels == 2
+            assert rule.bad_labels == 5
+            assert not fake.data[rule.label_key]
+
+    trio.run(main)
+
+
+def test_served_verdicts_are_not_training_samples():
+    async def main():
+        async with fake_redis_db() as (fake, db):
+            rule = learning_rule(db)
+            session = Session()
+            assert await rule.on_command(session, Request(1))
+            assert await rule.on_command(session, Request(8))
+            await trio.sleep(rule.batch_window * 10)
+            assert rule.scored == 2
+            assert rule.outliers == 1
+            assert len(rule.reservoir) == 0
+
+    trio.run(main)
@@ -0,0 +1,116 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import hiredis
+import pytest
+import trio
+
+from src.caching import written_keys
+from tests.support import fake_redis_db
+
+
+def redis_commands(db) -> int:
+    return db.consul.metrics.counters.get("redis_commands", 0)
+
+
+@pytest.mark.parametrize("inp, keys", [
+    (("GET", "a"), ()),
+    (("MGET", "a", "b"), ()),
+    (("PING",), ()),
+    (("SET", "a", "1", "EX", "10"), ("a",)),
+    (("LPOP", "a", 100), ("a",)),
+    (("DEL", "a", "b"), ("a", "b")),
+    (("MSET", "a", "1", "b", "2"), ("a", "b")),
+    (("RENAME", "a", "b"), ("a", "b")),
+    (("SETBIT", "a", 7, 1), ("a",)),
+    (("BITFIELD", "a", "SET", "u8", 0, 255), ("a",)),
+    (("BITOP", "AND", "dest", "a", "b"), ("dest",)),
+    (("RESTORE", "a", 0, "payload"), ("a",)),
+    (("MOVE", "a", 1), ("a",)),
+    (("EVALSHA", "0123abcd", 2, "a", "b", 1, 10), ("a", "b")),
+    (("EVALSHA", "0123abcd", 0, "a"), ()),
+    (("FLUSHDB",), None),
+])
+def test_written_keys(inp: tuple, keys):
+    assert written_keys(inp) == keys
+
+
+def test_ttl_cache_serves_hits_and_drops_written_keys():
+    async def main():
+        async with fake_redis_db(caching={"ttl": 60}) as (fake, db):
+            fake.data["fn:a"] = "one"
+            assert await db.execute("GET", "fn:a") == "one"
+            assert await db.execute("GET", "fn:a") == "one"
+            assert redis_commands(db) == 1
+            assert db.cache.hits == 1
+
+            await db.execute("LPOP", "queue", 100)
+            await db.execute("GET", "fn:a")
+            assert redis_commands(db) == 2
+
+            await db.execute("SET", "fn:a", "two")
+            assert await db.execute("GET", "fn:a") == "two"
+            assert redis_commands(db) == 4
+            assert not db.cache.fills
+
+    trio.run(main)
+
+
+def test_miss_is_stored_despite_writes_to_other_keys():
+    async def main():
+        async with fake_redis_db(caching={"ttl": 60}) as (fake, db):
+            fake.data["fn:a"] = "one"
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(db.execute, "GET", "fn:a")
+                for n in range(10):
+                    nursery.start_soon(db.execute, "SET", f"other:{n}", "x")
+            assert db.cache.lookup("fn:a") == (True, "one")
+
+    trio.run(main)
+
+
+def test_miss_racing_a_write_to_its_key_is_not_stored():
+    async def main():
+        async with fake_redis_db(caching={"ttl": 60}) as (fake, db):
+            fake.data["fn:a"] = "one"
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(db.execute, "GET", "fn:a")
+                nursery.start_soon(db.execute, "SET", "fn:a", "two")
+            assert db.cache.lookup("fn:a") == (False, None)
+            assert await db.execute("GET", "fn:a") == "two"
+
+    trio.run(main)
+
+
+async def wait_for(predicate, timeout: float = 5):
+    with trio.fail_after(timeout):
+        while not predicate():
+            await trio.sleep(0.01)
+
+
+def test_tracking_invalidations_drop_entries():
+    async def main():
+        caching = {"mode": "tracking", "prefixes": {"fn:": 60}}
+        async with fake_redis_db(caching=caching) as (fake, db):
+            await wait_for(lambda: fake.tracking)
+            assert list(fake.tracking.values())[0][1] == ("fn:",)
+            fake.data.update({"fn:a": "one", "fn:b": "one", "other": "one"})
+            for key in ("fn:a", "fn:b", "other"):
+                await db.execute("GET", key)
+            assert db.cache.lookup("fn:a") == (True, "one")
+            assert db.cache.lookup("other") == (False, None)
+
+            port = db.consul.config["redis"]["url"].rsplit(":", 1)[1].split("/")[0]
+            async with await trio.open_tcp_stream("127.0.0.1", int(port)) as writer:
+                await writer.send_all(hiredis.pack_command(("SET", "fn:a", "two")))
+                assert await writer.receive_some() == b"+OK\r\n"
+                await wait_for(lambda: "fn:a" not in db.cache.cache)
+                assert db.cache.lookup("fn:b") == (True, "one")
+                assert await db.execute("GET", "fn:a") == "two"
+
+                await writer.send_all(hiredis.pack_command(("FLUSHDB",)))
+                assert await writer.receive_some() == b"+OK\r\n"
+                await wait_for(lambda: not len(db.cache.cache))
+
+    trio.run(main)
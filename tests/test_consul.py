@@ -0,0 +1,55 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import pytest
+import trio
+import trio.testing
+
+from src.consul import SupremeConsul
+from src.errors import OverloadError
+from src.metrics import Metrics
+
+
+class OverloadedGatehouse:
+    async def execute(self, proto, addr) -> bool:
+        raise OverloadError()
+
+
+class Peer:
+    """A refused peer that has already reset, or that never reads."""
+
+    def __init__(self, error=None):
+        self.error = error
+        self.closed = False
+        self.socket = self
+
+    def getpeername(self):
+        return "10.0.0.1", 4000
+
+    async def send_all(self, data: bytes):
+        if self.error is None:
+            await trio.sleep_forever()
+        raise self.error
+
+    async def aclose(self):
+        self.closed = True
+        if self.error is not None:
+            raise self.error
+
+
+def overloaded_consul() -> SupremeConsul:
+    consul = SupremeConsul()
+    consul.gh = OverloadedGatehouse()
+    consul.metrics = Metrics()
+    return consul
+
+
+@pytest.mark.parametrize("error", [None, trio.BrokenResourceError(), trio.ClosedResourceError()])
+def test_refusal_survives_a_gone_peer(error):
+    consul = overloaded_consul()
+    peer = Peer(error)
+    trio.run(consul.create_session, peer, clock=trio.testing.MockClock(autojump_threshold=0))
+    assert peer.closed
+    assert consul.metrics.counters["connections_refused"] == 1
+    assert not consul.sessions
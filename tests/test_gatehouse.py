@@ -0,0 +1,95 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import pytest
+import trio
+import trio.testing
+
+from src.gatehouse.abc_rule import ABCRule
+from src.gatehouse.gatehouse import Gatehouse
+from src.metrics import Metrics
+from src.utils import IOQueue
+
+
+class Consul:
+    def __init__(self, **gatehouse):
+        self.config = {"gatehouse": gatehouse, "redis": {}}
+        self.db = type("DB", (), {"in_queue": IOQueue()})()
+        self.metrics = Metrics()
+
+
+class CommandRule(ABCRule):
+    name = "Command Rule"
+    watches_commands = True
+
+    def __init__(self, consul, verdict=True, fail_open=False):
+        super().__init__(consul)
+        self.verdict = verdict
+        self.fail_open = fail_open
+        self.seen = []
+
+    async def handle(self, proto, addr) -> bool:
+        return True
+
+    async def on_command(self, session, request) -> bool:
+        self.seen.append((session, request))
+        if isinstance(self.verdict, Exception):
+            raise self.verdict
+        return self.verdict
+
+
+def gatehouse(rules, monkeypatch, **config) -> Gatehouse:
+    monkeypatch.setattr(Gatehouse, "discover_rules", lambda self: [])
+    gh = Gatehouse(Consul(**config))
+    gh.load_rules(rules)
+    return gh
+
+
+@pytest.mark.parametrize("verdict, fail_open, expected", [
+    (True, False, True),
+    (False, True, False),
+    (RuntimeError("rule crashed"), False, False),
+    (RuntimeError("rule crashed"), True, True),
+])
+def test_check_command(monkeypatch, verdict, fail_open, expected):
+    rule = CommandRule(None, verdict, fail_open)
+    gh = gatehouse([rule], monkeypatch)
+    assert gh.command_rules == [rule]
+    assert trio.run(gh.check_command, "session", "request") is expected
+    assert rule.seen == [("session", "request")]
+
+
+def test_check_command_stops_at_first_refusal(monkeypatch):
+    first, second = CommandRule(None, False), CommandRule(None, True)
+    gh = gatehouse([first, second], monkeypatch)
+    assert not trio.run(gh.check_command, "session", "request")
+    assert not second.seen
+
+
+class StalledRule(CommandRule):
+    async def on_command(self, session, request) -> bool:
+        await trio.sleep_forever()
+
+
+@pytest.mark.parametrize("fail_open", [False, True])
+def test_check_command_times_out_to_fail_open(monkeypatch, fail_open):
+    rule = StalledRule(None, fail_open=fail_open)
+    rule.timeout = 0.05
+    gh = gatehouse([rule], monkeypatch)
+
+    async def main():
+        res = await gh.check_command("session", "request")
+        assert trio.current_time() == pytest.approx(0.05)
+        return res
+
+    assert trio.run(main, clock=trio.testing.MockClock(autojump_threshold=0)) is fail_open
+
+
+def test_execute_without_verdict_cache(monkeypatch):
+    gh = gatehouse([CommandRule(None)], monkeypatch, **{"verdict-ttl": 0})
+    assert gh.verdicts is None
+    for _ in range(2):
+        assert trio.run(gh.execute, None, ("10.0.0.1", 4000))
+    assert gh.verdict_misses == 2
+    assert gh.statistics()["in_flight"] == 0
@@ -0,0 +1,77 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import trio
+import trio.testing
+
+from src.heartbeat import HeartbeatScheduler
+from src.session_structure import HeartbeatBase
+
+CONFIG = {
+    "heartbeat": {
+        "hb-init-interval": 1000,
+        "hb-max-interval": 15000,
+        "hb-min-interval": 500,
+        "hb-timeout": 500,
+        "hb-detection-deadline": 10000,
+    }
+}
+
+
+class Consul:
+    config = CONFIG
+
+
+class IdleSession:
+    """A client that only sends HEARTBEAT, at the interval of the last ACK, until it dies."""
+
+    def __init__(self, scheduler: HeartbeatScheduler):
+        self.scheduler = scheduler
+        self.ht_base = HeartbeatBase(CONFIG)
+        self.heartbeat_seen = False
+        self.data_seen = False
+        self.interval = self.ht_base.heartbeat_interval_in_seconds
+        self.last_beat = 0.0
+        self.timed_out = trio.Event()
+        self.timed_out_at = 0.0
+
+    def push(self, frame: bytes):
+        self.interval = self.ht_base.heartbeat_interval_in_seconds
+
+    def timeout(self):
+        self.timed_out_at = trio.current_time()
+        self.timed_out.set()
+
+    async def beat(self, count: int):
+        for _ in range(count):
+            await trio.sleep(self.interval)
+            self.last_beat = trio.current_time()
+            self.scheduler.beat(self)
+
+
+def test_backoff_is_capped_by_the_detection_deadline():
+    base = HeartbeatBase(CONFIG)
+    for _ in range(50):
+        base.observe(base.last_activity_ts + 60)
+        base.heartbeat()
+    assert base.heartbeat_interval == (10000 - 500) / 2
+
+
+def test_idle_peer_backs_off_yet_dies_within_the_deadline():
+    async def main():
+        scheduler = HeartbeatScheduler(Consul())
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(scheduler.run)
+            for beats in range(1, 40, 3):
+                session = IdleSession(scheduler)
+                scheduler.register(session)
+                await session.beat(beats)
+                await session.timed_out.wait()
+                silence = session.timed_out_at - session.last_beat
+                assert silence <= 10 + scheduler.wheel.resolution, (beats, silence)
+                if beats > 10:
+                    assert session.interval > 1
+            nursery.cancel_scope.cancel()
+
+    trio.run(main, clock=trio.testing.MockClock(autojump_threshold=0))
@@ -0,0 +1,43 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import random
+
+import pytest
+
+from src.metrics import Histogram, Metrics
+
+
+def scanned(hist: Histogram, q: float) -> int:
+    rank = q / 100 * hist.count
+    seen = 0
+    for index, count in enumerate(hist.counts):
+        seen += count
+        if count and seen >= rank:
+            return min(hist._upper(index), hist.max)
+    return hist.max
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_percentiles_match_a_per_quantile_scan(seed: int):
+    rng = random.Random(seed)
+    hist = Histogram()
+    for _ in range(rng.randrange(1, 2000)):
+        hist.record(int(rng.lognormvariate(rng.uniform(0, 20), 2)))
+    qs = (99.9, 0, 50, 0.1, 99, 100)
+    assert hist.percentiles(qs) == [scanned(hist, q) for q in qs]
+
+
+def test_empty_histogram_percentiles_are_zero():
+    assert Histogram().percentiles((50, 99)) == [0, 0]
+
+
+def test_summaries_report_every_percentile():
+    metrics = Metrics()
+    for value in range(1, 1001):
+        metrics.record("command_get", value * 1000)
+    summary = metrics.summaries()
+    assert summary["command_get_count"] == 1000
+    assert summary["command_get_p50_ms"] == pytest.approx(0.5, rel=0.05)
+    assert summary["command_get_p999_ms"] <= summary["command_get_max_ms"] == 1.0
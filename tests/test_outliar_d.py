@@ -0,0 +1,46 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import numpy as np
+import pytest
+
+from src.gatehouse.outliar_d import ReqClassifier, ReqModel
+
+
+@pytest.fixture(scope="module")
+def classifier() -> ReqClassifier:
+    res = ReqClassifier()
+    res.fit()
+    return res
+
+
+@pytest.fixture
+def model(classifier: ReqClassifier, tmp_path) -> ReqModel:
+    path = tmp_path / "req_model.joblib"
+    classifier.export(path)
+    res = ReqModel.load(path)
+    res.build_grid(11, 11)
+    return res
+
+
+def test_grid_agrees_with_the_trained_pipeline(classifier: ReqClassifier, model: ReqModel):
+    features = classifier.test_features
+    grid = model.predict(features)
+    original = np.array([classifier.predict(risk, command_cn) for risk, command_cn in features]).astype(bool)
+
+    assert len(features) == len(classifier.test_y)
+    assert (grid == original).all()
+    assert all(model.lookup(risk, command_cn) is not None for risk, command_cn in features)
+
+
+def test_inputs_outside_the_density_support_are_outliers(model: ReqModel):
+    features = np.array([[50, 3], [3, 50], [100, 100], [1, 1]], dtype=np.float64)
+    assert model.lookup(50, 3) is None
+    assert model.predict(features).tolist() == [True, True, True, model.lookup(1, 1)]
+
+
+def test_labels_outside_the_density_support_still_train(model: ReqModel):
+    updated = model.updated([(50, 3, 1), (1, 1, 0)])
+    assert updated.grid.shape == model.grid.shape
+    assert updated.predict(np.array([[50.0, 3.0]])).tolist() == [True]
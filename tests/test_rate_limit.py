@@ -0,0 +1,126 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import trio
+
+from src.gatehouse.rules.rate_limit import TOKEN_BUCKET_SHA, Rule
+from tests.support import fake_redis_db
+
+
+def shared_rule(db) -> Rule:
+    db.consul.config["gatehouse"] = {"rate-limit": {"enabled": True, "mode": "redis"}}
+    db.consul.db = db
+    return Rule(db.consul)
+
+
+def test_noscript_falls_back_to_eval_once():
+    async def main():
+        async with fake_redis_db() as (fake, db):
+            rule = shared_rule(db)
+            fake.script_result = 0
+            assert not await rule.shared_take("10.0.0.1", "10.0.0.0/24", False)
+            assert TOKEN_BUCKET_SHA in fake.scripts
+            assert db.consul.metrics.counters["redis_commands"] == 2
+
+            fake.script_result = 1
+            assert await rule.shared_take("10.0.0.1", "10.0.0.0/24", True)
+            assert db.consul.metrics.counters["redis_commands"] == 3
+
+    trio.run(main)
+
+
+def test_shared_mode_limits_through_redis():
+    async def main():
+        async with fake_redis_db() as (fake, db):
+            rule = shared_rule(db)
+            fake.script_result = 0
+            assert not await rule.handle(None, ("10.0.0.1", 4000))
+            assert rule.limited == 1
+
+    trio.run(main)
+
+
+def test_other_redis_errors_fail_open_without_eval():
+    async def main():
+        async with fake_redis_db() as (fake, db):
+            rule = shared_rule(db)
+            call = fake.call
+            fake.call = lambda client, command: \
+                b"-BUSY Redis is busy running a script\r\n" if command[0] == "EVALSHA" else call(client, command)
+            fake.script_result = 0
+            assert await rule.shared_take("10.0.0.1", "10.0.0.0/24", False)
+            assert db.consul.metrics.counters["redis_commands"] == 1
+            assert not fake.scripts
+
+    trio.run(main)
+
+
+class Peer:
+    def __init__(self, host: str):
+        self.socket = self
+        self.host = host
+
+    def getpeername(self):
+        return self.host, 4000
+
+
+class Session:
+    def __init__(self, host: str):
+        self.proto = Peer(host)
+        self.rule_state = {}
+
+
+def local_rule(**config) -> Rule:
+    consul = type("Consul", (), {})()
+    consul.config = {"gatehouse": {"rate-limit": {
+        "enabled": True, "command-rate": 8, "command-burst": 3, "subnet-command-rate": 1000,
+        "subnet-command-burst": 1000, **config
+    }}}
+    return Rule(consul)
+
+
+def commands(rule: Rule, session: Session, count: int) -> list[bool]:
+    async def main():
+        return [await rule.on_command(session, None) for _ in range(count)]
+
+    return trio.run(main)
+
+
+def test_local_command_burst_and_refill(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("src.gatehouse.rules.rate_limit.time.monotonic", lambda: now[0])
+    rule, session = local_rule(), Session("10.0.0.1")
+    assert commands(rule, session, 4) == [True, True, True, False]
+    assert rule.limited == 1
+    now[0] += 0.125
+    assert commands(rule, session, 2) == [True, False]
+    now[0] += 10
+    assert commands(rule, session, 4) == [True, True, True, False]
+
+
+def test_busy_ips_stay_in_the_table_under_churn(monkeypatch):
+    monkeypatch.setattr("src.gatehouse.rules.rate_limit.time.monotonic", lambda: 100.0)
+    rule, busy = local_rule(slots=2), Session("10.0.0.1")
+    assert commands(rule, busy, 3) == [True, True, True]
+    for n in range(2, 6):
+        assert commands(rule, busy, 1) == [False]
+        assert commands(rule, Session(f"10.0.{n}.1"), 1) == [True]
+    assert "10.0.0.1" in rule.ips.index
+    assert commands(rule, busy, 1) == [False]
+
+
+def test_evicted_slot_is_not_reused_by_a_stale_session(monkeypatch):
+    monkeypatch.setattr("src.gatehouse.rules.rate_limit.time.monotonic", lambda: 100.0)
+    rule, first = local_rule(slots=1), Session("10.0.0.1")
+    assert commands(rule, first, 3) == [True, True, True]
+    idx, generation = first.rule_state[rule][2], first.rule_state[rule][3]
+
+    second = Session("10.0.1.1")
+    assert commands(rule, second, 3) == [True, True, True]
+    assert second.rule_state[rule][2] == idx
+    assert rule.ips.generation[idx] == generation + 1
+
+    assert commands(rule, first, 1) == [True]
+    assert first.rule_state[rule][3] == rule.ips.generation[idx]
+    assert commands(rule, second, 1) == [True]
@@ -0,0 +1,133 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import pytest
+import trio
+from redio.exc import ServerError
+
+from src.handling import Handler
+from src.middleware.serialisation import CommandSpec, Request
+from src.red_db import RedisTPCS
+from tests.support import Consul, fake_redis_db
+
+CALLERS = 5000
+
+
+def test_concurrent_callers_get_their_own_replies():
+    replies = {}
+    errors = {}
+
+    async def caller(db: RedisTPCS, n: int):
+        if n % 7 == 0:
+            try:
+                await db.execute(f"BOGUS{n}")
+            except ServerError as err:
+                errors[n] = str(err)
+            return
+        replies[n] = await db.execute("GET", f"key:{n}")
+
+    async def main():
+        async with fake_redis_db({"batch-size": 64}) as (fake, db):
+            async with trio.open_nursery() as nursery:
+                for n in range(CALLERS):
+                    nursery.start_soon(db.execute, "SET", f"key:{n}", f"value-{n}")
+            async with trio.open_nursery() as nursery:
+                for n in range(CALLERS):
+                    nursery.start_soon(caller, db, n)
+            assert not db.pending
+
+    trio.run(main)
+    assert replies == {n: f"value-{n}" for n in range(CALLERS) if n % 7}
+    assert errors == {n: f"ERR unknown command 'BOGUS{n}'" for n in range(0, CALLERS, 7)}
+
+
+def test_connection_errors_reach_every_caller():
+    failures = []
+
+    async def caller(db: RedisTPCS, n: int):
+        with pytest.raises(OSError):
+            await db.execute("GET", f"key:{n}")
+        failures.append(n)
+
+    async def main():
+        with trio.socket.socket() as sock:
+            await sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        db = RedisTPCS(Consul(f"redis://127.0.0.1:{port}/0"))
+        await db.starter()
+        async with trio.open_nursery() as nursery:
+            for n in range(100):
+                nursery.start_soon(caller, db, n)
+        assert not db.pending
+
+    trio.run(main)
+    assert sorted(failures) == list(range(100))
+
+
+@pytest.mark.parametrize("coalesce, commands", [(True, 1), (False, 100)])
+def test_gets_coalesce_into_one_mget_only_when_opted_in(coalesce: bool, commands: int):
+    replies = {}
+
+    async def caller(db: RedisTPCS, n: int):
+        replies[n] = await db.execute("GET", f"key:{n % 10}", coalesce=coalesce)
+
+    async def main():
+        async with fake_redis_db({"coalesce-window": 5}) as (fake, db):
+            fake.data.update({f"key:{n}": f"value-{n}" for n in range(10)})
+            async with trio.open_nursery() as nursery:
+                for n in range(100):
+                    nursery.start_soon(caller, db, n)
+            assert db.consul.metrics.counters["redis_commands"] == commands
+
+    trio.run(main)
+    assert replies == {n: f"value-{n % 10}" for n in range(100)}
+
+
+def test_failed_mget_fails_every_coalesced_get():
+    failures = []
+
+    async def caller(db: RedisTPCS, n: int):
+        with pytest.raises(OSError):
+            await db.execute("GET", f"key:{n}", coalesce=True)
+        failures.append(n)
+
+    async def main():
+        with trio.socket.socket() as sock:
+            await sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        db = RedisTPCS(Consul(f"redis://127.0.0.1:{port}/0"))
+        await db.starter()
+        async with trio.open_nursery() as nursery:
+            for n in range(10):
+                nursery.start_soon(caller, db, n)
+        assert not db.coalescer.gets
+
+    trio.run(main)
+    assert sorted(failures) == list(range(10))
+
+
+@pytest.mark.parametrize("coalesce, commands", [(True, 1), (False, 100)])
+def test_handler_opens_the_mget_window_for_coalescing_commands(coalesce: bool, commands: int):
+    replies = {}
+    spec = CommandSpec("profile", "get", "profileGet", [{"name": "id", "type": "int"}], coalesce=coalesce)
+
+    async def main():
+        async with fake_redis_db({"coalesce-window": 5}) as (fake, db):
+            fake.data.update({f"profile:{n}": f"name-{n}" for n in range(10)})
+            handler = Handler(db.consul)
+
+            async def profile_get(proto, profile_id: int):
+                return await db.execute("GET", f"profile:{profile_id}")
+
+            async def dispatch(n: int):
+                replies[n] = await handler.handle(None, Request("profile", "get", (n % 10,), spec))
+
+            handler.add_command("profile_get", profile_get)
+            async with trio.open_nursery() as nursery:
+                for n in range(100):
+                    nursery.start_soon(dispatch, n)
+            assert db.consul.metrics.counters["redis_commands"] == commands
+
+    trio.run(main)
+    assert replies == {n: f"name-{n % 10}" for n in range(100)}
@@ -0,0 +1,60 @@
+#
+#  Copyright (C) 2024-present Lovania
+#
+
+import os
+
+import hiredis
+import pytest
+
+from src.middleware.serialisation import CommandSpec, ReaderMIL, SerialiserMIL
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+
+
+@pytest.fixture
+def serialiser(monkeypatch) -> SerialiserMIL:
+    monkeypatch.chdir(SRC)
+    return SerialiserMIL()
+
+
+@pytest.mark.parametrize("frame", [[], 1, None, "PING", [["INFO"]], ["SLOWLOG", 5]])
+def test_malformed_frames_become_invalid_requests(serialiser: SerialiserMIL, frame):
+    req, = serialiser.handle([frame])
+    assert req.spec is None
+    assert req.error == "invalid request, expected an array of bulk strings"
+
+
+def test_frames_after_a_malformed_one_still_parse(serialiser: SerialiserMIL):
+    bad, good = serialiser.handle([[], ["SLOWLOG", "GET", "5"]])
+    assert bad.error is not None
+    assert good.error is None
+    assert good.spec.key == "slowlog_get"
+    assert good.args == (5,)
+
+
+def test_non_utf8_frames_keep_their_bytes(serialiser: SerialiserMIL):
+    reader = hiredis.Reader(encoding="utf-8", errors="surrogateescape")
+    chunk = b"*3\r\n$7\r\nSLOWLOG\r\n$3\r\nGET\r\n$1\r\n5\r\n*1\r\n$2\r\n\xff\xfe\r\n*2\r\n$7\r\nSLOWLOG\r\n$3\r\nLEN\r\n"
+    first, bad, last = serialiser.handle(ReaderMIL().handle((reader, chunk)))
+    assert first.spec.key == "slowlog_get"
+    assert bad.spec is None and bad.this.encode("utf-8", "surrogateescape") == b"\xff\xfe"
+    assert last.spec.key == "slowlog_len"
+
+
+def test_bytes_arguments_receive_the_raw_bulk_string():
+    spec = CommandSpec("echo", None, "echo", [{"name": "data", "type": "bytes"}])
+    assert spec.coerce(("\udcff\udcfeok",)) == (b"\xff\xfeok",)
+
+
+@pytest.mark.parametrize("frame", [["SLOWLOG", "LEN", "x"], ["SLOWLOG", "RESET", "1", "2"], ["INFO", "a", "b"]])
+def test_extra_arguments_are_rejected(serialiser: SerialiserMIL, frame):
+    req, = serialiser.handle([frame])
+    assert req.spec is not None
+    assert "expects at most" in req.error
+
+
+def test_commands_without_arguments_parse(serialiser: SerialiserMIL):
+    req, = serialiser.handle([["SLOWLOG", "LEN"]])
+    assert req.error is None
+    assert req.args == ()